@@ -0,0 +1,271 @@
+import array
+import curses
+import os
+import select
+import sys
+import termios
+
+import Headless
+import UIEngine
+
+# A screen backend that writes ANSI escape sequences to the terminal
+# itself. The cells drawn are kept in the virtual screen (the back grid) and
+# what's on the terminal in the physical one (the front grid). doupdate()
+# diffs the two row by row and only sends the cells that changed, which
+# matters on slow links.
+
+# Unchanged cells between two changed runs are rewritten rather than moving
+# the cursor over them, if there are at most this many
+GAP = 6
+
+# Escape sequences of the keys the UI knows about, as curses would map them
+KEYS = {
+    b'\x1b[A': curses.KEY_UP,
+    b'\x1b[B': curses.KEY_DOWN,
+    b'\x1b[C': curses.KEY_RIGHT,
+    b'\x1b[D': curses.KEY_LEFT,
+    b'\x1bOA': curses.KEY_UP,
+    b'\x1bOB': curses.KEY_DOWN,
+    b'\x1bOC': curses.KEY_RIGHT,
+    b'\x1bOD': curses.KEY_LEFT,
+    b'\x1b[H': curses.KEY_HOME,
+    b'\x1b[F': curses.KEY_END,
+    b'\x1bOH': curses.KEY_HOME,
+    b'\x1bOF': curses.KEY_END,
+    b'\x1b[1~': curses.KEY_HOME,
+    b'\x1b[2~': curses.KEY_IC,
+    b'\x1b[3~': curses.KEY_DC,
+    b'\x1b[4~': curses.KEY_END,
+    b'\x1b[5~': curses.KEY_PPAGE,
+    b'\x1b[6~': curses.KEY_NPAGE,
+    b'\x1b[7~': curses.KEY_HOME,
+    b'\x1b[8~': curses.KEY_END,
+}
+
+# curses attribute -> SGR parameter
+ATTRIBUTES = (
+    (curses.A_BOLD, '1'),
+    (curses.A_DIM, '2'),
+    (getattr(curses, 'A_ITALIC', 0), '3'),
+    (curses.A_UNDERLINE, '4'),
+    (curses.A_BLINK, '5'),
+    (curses.A_REVERSE, '7'),
+    (curses.A_STANDOUT, '7'),
+)
+
+def _color(base, color):
+    if color < 0:
+        return str(base + 9) # default color
+    if color < 8:
+        return str(base + color)
+    return '%d;5;%d' % (base + 8, color)
+
+class Backend(Headless.Backend):
+
+    def __init__(self, infd=None, outfd=None):
+        self.infd = sys.__stdin__.fileno() if infd is None else infd
+        self.outfd = sys.__stdout__.fileno() if outfd is None else outfd
+
+        try:
+            size = os.get_terminal_size(self.outfd)
+            rows, cols = size.lines, size.columns
+        except OSError:
+            rows, cols = 24, 80
+        Headless.Backend.__init__(self, rows, cols)
+
+        self.pairs = dict() # color pair -> (foreground, background)
+        self._sgr = dict() # attributes -> SGR sequence
+        self._started = False
+        self._saved_mode = None # terminal mode to restore in stop()
+
+        # what the terminal is at, None if not known
+        self._terminal_attr = 0
+        self._terminal_cursor = None
+
+        # bytes written by the last doupdate() and in total
+        self.frame_bytes = 0
+        self.total_bytes = 0
+
+    def run(self, fn):
+        try:
+            return fn(self.screen)
+        finally:
+            self.stop()
+
+    def start(self, screen):
+        # Like curses' cbreak, noecho and nonl: keys are read one by one,
+        # Ctrl+C still works and Enter reads as 13
+        if os.isatty(self.infd):
+            self._saved_mode = termios.tcgetattr(self.infd)
+            mode = termios.tcgetattr(self.infd)
+            mode[0] &= ~(termios.ICRNL | termios.IXON)
+            mode[3] &= ~(termios.ICANON | termios.ECHO)
+            mode[6][termios.VMIN] = 1
+            mode[6][termios.VTIME] = 0
+            termios.tcsetattr(self.infd, termios.TCSANOW, mode)
+        self._started = True
+
+        for n, (fg, bg) in UIEngine.COLOR_PAIRS.items():
+            self.init_pair(n, fg, bg)
+
+        # alternate screen, bracketed paste
+        self._write(b'\x1b[?1049h\x1b[?2004h\x1b[0m\x1b[H\x1b[2J')
+        self.clear_screen = False
+        self._terminal_attr = 0
+        self._terminal_cursor = (0, 0)
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        self._write(b'\x1b[0m\x1b[?2004l\x1b[?1049l')
+        if self._saved_mode is not None:
+            termios.tcsetattr(self.infd, termios.TCSADRAIN, self._saved_mode)
+            self._saved_mode = None
+
+    def on_resize(self):
+        size = os.get_terminal_size(self.outfd)
+        self.resize(size.lines, size.columns)
+        self.clear_screen = True
+
+    def _write(self, data):
+        while len(data) > 0:
+            try:
+                n = os.write(self.outfd, data)
+            except BlockingIOError:
+                select.select([], [self.outfd], [])
+                continue
+            data = data[n:]
+
+    # Input
+
+    def getch(self):
+        # Like curses with nodelay(), -1 when there's nothing to read
+        if len(self.keys) == 0 and select.select([self.infd], [], [], 0)[0]:
+            self._parse_keys(os.read(self.infd, 4096))
+        return Headless.Backend.getch(self)
+
+    def _parse_keys(self, data):
+        # Known escape sequences become curses key codes, everything else is
+        # passed on byte by byte like curses does
+        i = 0
+        while i < len(data):
+            if data[i] == 27:
+                for n in (3, 4):
+                    key = KEYS.get(data[i:i+n])
+                    if key is not None:
+                        self.keys.append(key)
+                        i += n
+                        break
+                else:
+                    self.keys.append(27)
+                    i += 1
+                continue
+            self.keys.append(data[i])
+            i += 1
+
+    # Output
+
+    def init_pair(self, n, fg, bg):
+        self.pairs[n] = (fg, bg)
+
+    def _attr_sgr(self, attr):
+        sgr = self._sgr.get(attr)
+        if sgr is None:
+            params = ['0']
+            for flag, param in ATTRIBUTES:
+                if attr & flag:
+                    params.append(param)
+            pair = (attr & curses.A_COLOR) >> 8
+            if pair in self.pairs:
+                fg, bg = self.pairs[pair]
+                params.append(_color(30, fg))
+                params.append(_color(40, bg))
+            sgr = '\x1b[' + ';'.join(params) + 'm'
+            self._sgr[attr] = sgr
+        return sgr
+
+    def doupdate(self):
+        self.updates += 1
+        out = []
+
+        full = self.clear_screen
+        if full:
+            out.append('\x1b[0m\x1b[H\x1b[2J')
+            self._terminal_attr = 0
+            self._terminal_cursor = (0, 0)
+            self._physical = Headless._blank_rows(self.rows, self.cols)
+            self.clear_screen = False
+
+        cols = self.cols
+        for y in range(self.rows):
+            back = self._virtual[y]
+            front = self._physical[y]
+            if back == front:
+                continue
+
+            x = 0
+            while x < cols:
+                if back[x] == front[x]:
+                    x += 1
+                    continue
+
+                # A changed run, it ends after more than GAP unchanged cells
+                start = x
+                if back[start] & Headless.CHAR_MASK == 0 and start > 0:
+                    start -= 1 # right half of a wide character
+                end = x + 1
+                same = 0
+                for j in range(x + 1, cols):
+                    if back[j] != front[j]:
+                        end = j + 1
+                        same = 0
+                    else:
+                        same += 1
+                        if same > GAP:
+                            break
+                while end < cols and back[end] & Headless.CHAR_MASK == 0:
+                    end += 1
+
+                self._move(out, y, start)
+                self._cells(out, back, start, end)
+                x = end
+
+            self._physical[y] = array.array('Q', back)
+
+        cy, cx = self.cursor
+        self._move(out, min(cy, self.rows-1), min(cx, cols-1))
+
+        data = ''.join(out).encode('utf-8')
+        self.frame_bytes = len(data)
+        self.total_bytes += len(data)
+        self._write(data)
+
+    def _move(self, out, y, x):
+        if self._terminal_cursor != (y, x):
+            out.append('\x1b[%d;%dH' % (y+1, x+1))
+            self._terminal_cursor = (y, x)
+
+    def _cells(self, out, row, start, end):
+        wide = False # whether the previous cell was a wide character
+        for x in range(start, end):
+            cell = row[x]
+            ch = cell & Headless.CHAR_MASK
+            attr = cell >> Headless.CHAR_BITS
+            if ch == 0 and wide:
+                wide = False
+                continue # the terminal moved past it already
+            if attr != self._terminal_attr:
+                out.append(self._attr_sgr(attr))
+                self._terminal_attr = attr
+            if ch == 0 or ch < 32 or ch == 127:
+                ch = ord(' ' if ch == 0 else '?')
+            out.append(chr(ch))
+            wide = x + 1 < end and row[x+1] & Headless.CHAR_MASK == 0
+
+        if end < self.cols:
+            self._terminal_cursor = (self._terminal_cursor[0], end)
+        else:
+            # The cursor waits at the right edge, where exactly depends on
+            # the terminal
+            self._terminal_cursor = None
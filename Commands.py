@@ -0,0 +1,131 @@
+class TrieNode:
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = dict() # character -> TrieNode
+        self.value = None
+
+class Trie:
+    # Maps strings to values. Looking up a key or the keys starting with a
+    # prefix costs the length of the prefix plus the amount of results, not
+    # the amount of keys.
+
+    def __init__(self):
+        self._root = TrieNode()
+
+    def insert(self, key, value):
+        node = self._root
+        for c in key:
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = TrieNode()
+            node = child
+        node.value = value
+
+    def _find(self, prefix):
+        node = self._root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                return None
+        return node
+
+    def get(self, key):
+        node = self._find(key)
+        return node.value if node is not None else None
+
+    def complete(self, prefix):
+        # Sorted keys starting with prefix
+        node = self._find(prefix)
+        if node is None:
+            return []
+        keys = []
+        stack = [(prefix, node)]
+        while len(stack) > 0:
+            key, node = stack.pop()
+            if node.value is not None:
+                keys.append(key)
+            for c in sorted(node.children, reverse=True):
+                stack.append((key + c, node.children[c]))
+        return keys
+
+
+class CommandError(Exception):
+    pass
+
+class Command:
+    # args is the argument schema: a name per argument, '[name]' for an
+    # optional one and 'name...' for one taking the rest of the line
+
+    def __init__(self, name, args, handler, help):
+        self.name = name
+        self.args = args
+        self.handler = handler
+        self.help = help
+
+    def usage(self):
+        return ' '.join(['/' + self.name] + ['<' + arg + '>' if arg[0] != '[' else arg for arg in self.args])
+
+    def parse(self, text):
+        # The arguments in text as a list, missing optional ones are None
+        rest = len(self.args) > 0 and self.args[-1].rstrip(']').endswith('...')
+        if rest:
+            values = text.split(None, len(self.args) - 1)
+        else:
+            values = text.split()
+
+        if len(values) > len(self.args):
+            raise CommandError('Too many arguments, usage: ' + self.usage())
+        required = len([arg for arg in self.args if arg[0] != '['])
+        if len(values) < required:
+            raise CommandError('Missing arguments, usage: ' + self.usage())
+
+        return values + [None] * (len(self.args) - len(values))
+
+class Commands:
+    # Registry of the /commands. Commands can be called by any unambiguous
+    # prefix of their name.
+
+    def __init__(self):
+        self._commands = Trie() # name or alias -> Command
+
+    def register(self, name, args, handler, help='', aliases=()):
+        command = Command(name, args, handler, help)
+        self._commands.insert(name, command)
+        for alias in aliases:
+            self._commands.insert(alias, command)
+        return command
+
+    def complete(self, prefix):
+        # Names and aliases starting with prefix
+        return self._commands.complete(prefix)
+
+    def lookup(self, name):
+        command = self._commands.get(name)
+        if command is not None:
+            return command
+
+        matches = self.complete(name)
+        found = set(self._commands.get(match) for match in matches)
+        if len(found) == 1:
+            return found.pop()
+        if len(found) == 0:
+            raise CommandError('Unknown command: /' + name)
+        raise CommandError('Ambiguous command /' + name + ': ' + ', '.join('/' + match for match in matches))
+
+    def commands(self):
+        # Every command once, by name
+        found = dict()
+        for name in self._commands.complete(''):
+            command = self._commands.get(name)
+            found[command.name] = command
+        return [found[name] for name in sorted(found)]
+
+    def run(self, line):
+        # Run a command line without the leading /
+        parts = line.split(None, 1)
+        if len(parts) == 0:
+            raise CommandError('No command given')
+        command = self.lookup(parts[0])
+        args = command.parse(parts[1] if len(parts) > 1 else '')
+        command.handler(*args)
@@ -0,0 +1,63 @@
+import heapq
+import itertools
+
+class _Node:
+    __slots__ = ('children', 'name', 'stamp', 'best')
+
+    def __init__(self):
+        self.children = dict() # character -> _Node
+        self.name = None # name ending here, in its original case
+        self.stamp = 0 # when the name was last touched
+        self.best = 0 # newest stamp in this subtree
+
+class PrefixIndex:
+    # Names by case-insensitive prefix, most recently touched first. Every
+    # node knows the newest stamp below it, so complete() walks down the best
+    # branches first and stops after limit names, however many there are.
+
+    def __init__(self):
+        self._root = _Node()
+        self._clock = itertools.count(1)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def touch(self, name):
+        # Add name or make it the most recent one
+        stamp = next(self._clock)
+        node = self._root
+        node.best = stamp
+        for c in name.lower():
+            child = node.children.get(c)
+            if child is None:
+                child = node.children[c] = _Node()
+            node = child
+            node.best = stamp
+        if node.name is None:
+            self._size += 1
+        node.name = name
+        node.stamp = stamp
+
+    def complete(self, prefix, limit):
+        # Up to limit names starting with prefix, newest first
+        node = self._root
+        for c in prefix.lower():
+            node = node.children.get(c)
+            if node is None:
+                return []
+
+        # Best first search, names are queued as leaves with their own stamp
+        order = itertools.count()
+        queue = [(-node.best, next(order), node, False)]
+        names = []
+        while len(queue) > 0 and len(names) < limit:
+            _, _, node, leaf = heapq.heappop(queue)
+            if leaf:
+                names.append(node.name)
+                continue
+            if node.name is not None:
+                heapq.heappush(queue, (-node.stamp, next(order), node, True))
+            for child in node.children.values():
+                heapq.heappush(queue, (-child.best, next(order), child, False))
+        return names
@@ -0,0 +1,174 @@
+import threading
+import time
+
+class Event:
+    pass
+
+# Logging
+class Log(Event):
+    def __init__(self, msg):
+        self.msg = msg
+
+# ProtobufSocket -> IRCState
+class SocketConnected(Event):
+    pass
+
+class SocketClosed(Event):
+    pass
+
+class SocketMessage(Event):
+    def __init__(self, packet):
+        self.packet = packet
+
+# IRCState -> UI
+class CoreConnected(Event):
+    pass
+
+class CoreClosed(Event):
+    pass
+
+class NetworkListChanged(Event):
+    def __init__(self, networks):
+        self.networks = networks
+
+class BufferListChanged(Event):
+    def __init__(self, network):
+        self.network = network
+
+class NewBuffer(Event):
+    def __init__(self, network):
+        self.network = network
+
+class BufferMessage(Event):
+    # A line for the window of a buffer
+    def __init__(self, network, buffer, text):
+        self.network = network
+        self.buffer = buffer
+        self.text = text
+
+# Canvas -> UI
+class KeyMeta(Event):
+    def __init__(self, char):
+        self.char = char
+
+class KeyNavigate(Event):
+    def __init__(self, key):
+        self.key = key
+
+class KeyCharacter(Event):
+    def __init__(self, text):
+        self.text = text
+
+class Submit(Event):
+    # Enter was pressed in a text input
+    def __init__(self, widget, text):
+        self.widget = widget
+        self.text = text
+
+
+class Subscription:
+    def __init__(self, event_type, handler, coalesce, name):
+        self.event_type = event_type
+        self.handler = handler
+        self.coalesce = coalesce
+        self.name = name
+
+        # latest undelivered event of a coalescing subscription
+        self.pending = None
+
+        # timing stats
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def deliver(self, event):
+        start = time.perf_counter()
+        try:
+            self.handler(event)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+class EventBus:
+
+    def __init__(self):
+        self._subscriptions = dict() # event type -> [Subscription]
+        self._pending = [] # coalescing subscriptions waiting for flush()
+        self._lock = threading.Lock()
+
+        # called when a coalesced event becomes pending, so the owner can
+        # schedule a flush()
+        self.on_pending = None
+
+    def subscribe(self, event_type, handler, coalesce=False, name=None):
+        # Coalescing subscribers get at most one event (the latest one) per
+        # flush() instead of one call per publish()
+
+        if not isinstance(event_type, type) or not issubclass(event_type, Event):
+            raise TypeError('Can only subscribe to Event subclasses, not ' + repr(event_type))
+
+        if name is None:
+            name = getattr(handler, '__qualname__', repr(handler))
+
+        sub = Subscription(event_type, handler, coalesce, name)
+        with self._lock:
+            self._subscriptions.setdefault(event_type, []).append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscriptions.get(sub.event_type, [])
+            if sub in subs:
+                subs.remove(sub)
+            if sub in self._pending:
+                self._pending.remove(sub)
+            sub.pending = None
+
+    def publish(self, event):
+
+        if not isinstance(event, Event):
+            raise TypeError('Can only publish Event instances, not ' + repr(event))
+
+        immediate = []
+        notify = False
+
+        with self._lock:
+            # Subscribers of a base class receive the subclassed events too
+            for event_type in type(event).__mro__:
+                for sub in self._subscriptions.get(event_type, ()):
+                    if not sub.coalesce:
+                        immediate.append(sub)
+                        continue
+                    if sub.pending is None:
+                        self._pending.append(sub)
+                        notify = True
+                    sub.pending = event
+                if event_type is Event:
+                    break
+
+        for sub in immediate:
+            sub.deliver(event)
+
+        if notify and self.on_pending is not None:
+            self.on_pending()
+
+    def flush(self):
+        # Deliver the pending coalesced events
+
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            events = [(sub, sub.pending) for sub in pending]
+            for sub in pending:
+                sub.pending = None
+
+        for sub, event in events:
+            sub.deliver(event)
+
+    def stats(self):
+        # Subscriptions sorted by the total time spent in them
+        with self._lock:
+            subs = [sub for subs in self._subscriptions.values() for sub in subs]
+        return sorted(subs, key=lambda sub: sub.total_time, reverse=True)
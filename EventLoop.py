@@ -0,0 +1,173 @@
+import asyncore
+import collections
+import heapq
+import itertools
+import os
+import selectors
+import signal
+import time
+import traceback
+
+class EventLoop:
+    # Runs the whole client on one thread: file descriptors such as the
+    # terminal and the asyncore sockets are multiplexed with a selector.
+    #
+    # Other threads and signal handlers talk to the loop through
+    # call_soon_threadsafe(), which wakes select() up through a self-pipe.
+    #
+    # An exception from a callback is passed to logger as a traceback and
+    # the loop goes on. Without a logger it ends the loop.
+
+    def __init__(self, socket_map=None, logger=None):
+        self.logger = logger
+        self._selector = selectors.DefaultSelector()
+        self._socket_map = asyncore.socket_map if socket_map is None else socket_map
+        self._readers = dict() # fd -> callback
+        self._sockets = dict() # fd -> (dispatcher, registered events)
+        self._signals = []
+        self._halt = False
+
+        self._calls = collections.deque() # functions to run on the loop thread
+        self._timers = [] # heap of (time, sequence number, function)
+        self._timer_seq = itertools.count()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.add_reader(self._wakeup_r, self._on_wakeup)
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._selector.register(fd, selectors.EVENT_READ, ('reader', callback))
+
+    def remove_reader(self, fd):
+        if fd in self._readers:
+            del self._readers[fd]
+            self._selector.unregister(fd)
+
+    def wakeup(self):
+        # Make select() return right away. Safe to call from any thread and
+        # from signal handlers.
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass # the pipe is full, so a wakeup is pending anyway
+
+    def call_soon_threadsafe(self, fn):
+        self._calls.append(fn)
+        self.wakeup()
+
+    def call_later(self, delay, fn):
+        # Run fn on the loop after delay seconds. Only call from the loop
+        # thread, other threads go through call_soon_threadsafe().
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), fn))
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while len(self._timers) > 0 and self._timers[0][0] <= now:
+            self._call(heapq.heappop(self._timers)[2])
+
+    def _timer_timeout(self, timeout):
+        if len(self._timers) == 0:
+            return timeout
+        until = max(0.0, self._timers[0][0] - time.monotonic())
+        if timeout is None:
+            return until
+        return min(timeout, until)
+
+    def add_signal_handler(self, signum, callback):
+        # callback runs on the loop, not inside the signal handler
+        signal.signal(signum, lambda signum, frame: self.call_soon_threadsafe(callback))
+        self._signals.append(signum)
+
+    def _on_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while len(self._calls) > 0:
+            self._call(self._calls.popleft())
+
+    def _call(self, fn):
+        try:
+            fn()
+        except Exception:
+            self.handle_error()
+
+    def handle_error(self):
+        if self.logger is None:
+            raise
+        self.logger(traceback.format_exc())
+
+    def stop(self):
+        self._halt = True
+        self.wakeup()
+
+    def close(self):
+        for signum in self._signals:
+            signal.signal(signum, signal.SIG_DFL)
+        self._signals = []
+        self.remove_reader(self._wakeup_r)
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._selector.close()
+
+    def is_running(self):
+        return not self._halt
+
+    def _sync_sockets(self):
+        # asyncore dispatchers decide each round whether they want to read
+        # or write
+
+        for fd in list(self._sockets.keys()):
+            obj = self._sockets[fd][0]
+            if self._socket_map.get(fd) is not obj:
+                del self._sockets[fd]
+                self._selector.unregister(fd)
+
+        for fd, obj in list(self._socket_map.items()):
+            events = 0
+            if obj.readable():
+                events |= selectors.EVENT_READ
+            if obj.writable():
+                events |= selectors.EVENT_WRITE
+
+            if fd in self._sockets:
+                if self._sockets[fd][1] == events:
+                    continue
+                del self._sockets[fd]
+                self._selector.unregister(fd)
+            if events != 0:
+                self._sockets[fd] = (obj, events)
+                self._selector.register(fd, events, ('socket', obj))
+
+    def run(self, timeout_fn=None, idle_fn=None):
+        # timeout_fn returns the seconds until idle_fn wants to run (or None),
+        # idle_fn is called after every round of events. Without a timeout
+        # the loop sleeps until there's input or a wakeup().
+
+        while not self._halt:
+
+            self._sync_sockets()
+
+            timeout = None
+            if timeout_fn is not None:
+                timeout = timeout_fn()
+
+            timeout = self._timer_timeout(timeout)
+
+            for key, events in self._selector.select(timeout):
+                kind, target = key.data
+                if kind == 'reader':
+                    self._call(target)
+                    continue
+                if events & selectors.EVENT_READ:
+                    asyncore.read(target)
+                if events & selectors.EVENT_WRITE and self._socket_map.get(key.fd) is target:
+                    asyncore.write(target)
+
+            self._run_timers()
+
+            if idle_fn is not None:
+                self._call(idle_fn)
@@ -0,0 +1,150 @@
+import curses
+import re
+
+import TextWidth
+import UIEngine
+
+# mIRC formatting codes. Messages are parsed once when they're stored: the
+# codes are taken out of the text and the attributes they set are kept on
+# the TextWidth.Line as spans of (start offset, curses attributes, color
+# pair), so drawing a row only has to look up the spans it covers.
+
+BOLD = '\x02'
+COLOR = '\x03'
+HEX_COLOR = '\x04'
+RESET = '\x0f'
+MONOSPACE = '\x11'
+REVERSE = '\x16'
+ITALIC = '\x1d'
+STRIKETHROUGH = '\x1e'
+UNDERLINE = '\x1f'
+
+_ANY = re.compile('[\x02\x03\x04\x0f\x11\x16\x1d\x1e\x1f]')
+_CODE = re.compile('\x03(?:(\\d{1,2})(?:,(\\d{1,2}))?)?'
+                   '|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?'
+                   '|[\x02\x0f\x11\x16\x1d\x1e\x1f]')
+
+# Code -> curses attribute it toggles. There's nothing for monospace or
+# strikethrough, they're only taken out of the text.
+TOGGLES = {
+    BOLD: curses.A_BOLD,
+    REVERSE: curses.A_REVERSE,
+    ITALIC: getattr(curses, 'A_ITALIC', 0),
+    UNDERLINE: curses.A_UNDERLINE,
+    MONOSPACE: 0,
+    STRIKETHROUGH: 0,
+}
+
+# mIRC color -> curses color, the bright ones above 8 fall back to the
+# normal ones on terminals with 8 colors
+MIRC_COLORS = (
+    15, # white
+    0,  # black
+    4,  # blue
+    2,  # green
+    9,  # red
+    1,  # brown
+    5,  # purple
+    3,  # orange
+    11, # yellow
+    10, # light green
+    6,  # cyan
+    14, # light cyan
+    12, # light blue
+    13, # pink
+    8,  # grey
+    7,  # light grey
+)
+
+def _color(code, current):
+    # Color of a code's number, -1 for the default one
+    if code is None:
+        return current
+    n = int(code)
+    if n < len(MIRC_COLORS):
+        return MIRC_COLORS[n]
+    return -1 # 99 and unknown colors
+
+def parse(raw):
+    # (text, spans) of raw, spans is None when there's no formatting
+
+    if _ANY.search(raw) is None:
+        return raw, None
+
+    text = []
+    length = 0
+    spans = [(0, 0, 0)]
+    attr = 0
+    fg = bg = -1
+    pos = 0
+
+    for match in _CODE.finditer(raw):
+        if match.start() > pos:
+            text.append(raw[pos:match.start()])
+            length += match.start() - pos
+        pos = match.end()
+
+        code = raw[match.start()]
+        if code == COLOR:
+            if match.group(1) is None:
+                fg = bg = -1
+            else:
+                fg = _color(match.group(1), fg)
+                bg = _color(match.group(2), bg)
+        elif code == HEX_COLOR:
+            pass
+        elif code == RESET:
+            attr = 0
+            fg = bg = -1
+        else:
+            attr ^= TOGGLES[code]
+
+        pair = 0 if fg == -1 and bg == -1 else UIEngine.find_color_pair(fg, bg)
+        if spans[-1][0] == length:
+            spans.pop() # nothing was written with the previous attributes
+        if len(spans) == 0 or spans[-1][1:] != (attr, pair):
+            spans.append((length, attr, pair))
+
+    if pos < len(raw):
+        text.append(raw[pos:])
+        length += len(raw) - pos
+    if len(spans) > 1 and spans[-1][0] == length:
+        spans.pop() # codes at the end
+    if len(spans) == 1 and spans[0][1:] == (0, 0):
+        spans = None
+    return ''.join(text), spans
+
+def strip(raw):
+    # raw without its codes
+    if _ANY.search(raw) is None:
+        return raw
+    return _CODE.sub('', raw)
+
+def line(raw):
+    # A TextWidth.Line with the formatting of raw
+    text, spans = parse(raw)
+    return TextWidth.Line(text, spans, raw if spans is not None else None)
+
+def segments(line, w, i):
+    # (text, attributes) runs of row i of line wrapped to w cells
+    breaks = line.breaks(w)
+    start = breaks[i]
+    end = breaks[i+1] if i+1 < len(breaks) else len(line.text)
+
+    if line.spans is None:
+        return [(line.text[start:end], 0)]
+
+    runs = []
+    spans = line.spans
+    for j in range(len(spans)):
+        span_start = spans[j][0]
+        span_end = spans[j+1][0] if j+1 < len(spans) else len(line.text)
+        if span_end <= start or span_end <= span_start:
+            continue
+        if span_start >= end:
+            break
+        attr = spans[j][1]
+        if spans[j][2] != 0:
+            attr |= UIEngine.color_pair(spans[j][2])
+        runs.append((line.text[max(start, span_start):min(end, span_end)], attr))
+    return runs
@@ -0,0 +1,74 @@
+class GapBuffer:
+    # Editable text with a cursor. The characters are kept in a list with a
+    # gap of unused slots at the cursor, so typing, deleting and pasting at
+    # the cursor only touch the text being changed instead of copying the
+    # whole string. Moving the cursor moves the gap along with it.
+
+    # Minimum size of a new gap
+    GAP = 64
+
+    def __init__(self, text=''):
+        self._buf = list(text) + [None] * GapBuffer.GAP
+        self._start = len(text) # the gap is self._buf[self._start:self._end]
+        self._end = len(self._buf)
+        self._text = text # cached result of text(), None when stale
+
+    def __len__(self):
+        return len(self._buf) - (self._end - self._start)
+
+    @property
+    def cursor(self):
+        return self._start
+
+    def text(self):
+        if self._text is None:
+            self._text = ''.join(self._buf[:self._start]) + ''.join(self._buf[self._end:])
+        return self._text
+
+    def move(self, pos):
+        # Move the cursor (and the gap) to pos
+        pos = max(0, min(pos, len(self)))
+        if pos < self._start:
+            n = self._start - pos
+            self._buf[self._end-n:self._end] = self._buf[pos:self._start]
+            self._start -= n
+            self._end -= n
+        elif pos > self._start:
+            n = pos - self._start
+            self._buf[self._start:self._start+n] = self._buf[self._end:self._end+n]
+            self._start += n
+            self._end += n
+
+    def insert(self, text):
+        # Insert text at the cursor and move the cursor after it
+        n = len(text)
+        if n == 0:
+            return
+        if self._end - self._start < n:
+            # Grow the gap, at least doubling the buffer so that typing
+            # stays amortized O(1) per character
+            grow = max(n, len(self._buf), GapBuffer.GAP)
+            self._buf[self._start:self._start] = [None] * grow
+            self._end += grow
+        self._buf[self._start:self._start+n] = text
+        self._start += n
+        self._text = None
+
+    def delete_back(self, n=1):
+        # Backspace, returns the amount of characters removed
+        n = min(n, self._start)
+        self._start -= n
+        if n > 0:
+            self._text = None
+        return n
+
+    def delete_forward(self, n=1):
+        # Delete, returns the amount of characters removed
+        n = min(n, len(self._buf) - self._end)
+        self._end += n
+        if n > 0:
+            self._text = None
+        return n
+
+    def set_text(self, text):
+        self.__init__(text)
@@ -0,0 +1,338 @@
+import array
+import collections
+import curses
+import TextWidth
+
+# A screen backend that keeps everything in memory, for benchmarking the
+# rendering code and comparing frames without a terminal. The windows and
+# pads implement the part of the curses API the UI uses.
+#
+# Cells are stored one per array item: the character in the low bits and
+# the curses attributes above them. The right half of a wide character is
+# a cell with no character.
+
+CHAR_BITS = 21
+CHAR_MASK = (1 << CHAR_BITS) - 1
+BLANK = ord(' ')
+
+def _cell(ch, attr):
+    # ch may be a string or a curses chtype with attributes of its own
+    if isinstance(ch, int):
+        attr |= ch & ~curses.A_CHARTEXT
+        ch = ch & curses.A_CHARTEXT
+    else:
+        ch = ord(ch)
+    return ch | (attr << CHAR_BITS)
+
+def _blank_rows(h, w):
+    return [array.array('Q', [BLANK]) * w for _ in range(h)]
+
+class Window:
+    # Draws into self._rows, which derived windows share with their parent.
+    # Like in curses, each window remembers the rows written through it and
+    # noutrefresh() only copies those.
+
+    def __init__(self, backend, rows, oy, ox, h, w, by, bx):
+        self._backend = backend
+        self._rows = rows
+        self._oy = oy # position in self._rows
+        self._ox = ox
+        self._h = h
+        self._w = w
+        self._by = by # position on the screen
+        self._bx = bx
+        self._cy = 0
+        self._cx = 0
+        self._touched = set(range(h)) # rows changed since the last noutrefresh()
+
+    def getmaxyx(self):
+        return (self._h, self._w)
+
+    def getbegyx(self):
+        return (self._by, self._bx)
+
+    def derwin(self, h, w, y, x):
+        if y < 0 or x < 0 or h <= 0 or w <= 0 or y + h > self._h or x + w > self._w:
+            raise curses.error('derwin() returned NULL')
+        return Window(self._backend, self._rows, self._oy + y, self._ox + x, h, w, self._by + y, self._bx + x)
+
+    def move(self, y, x):
+        if y < 0 or x < 0 or y >= self._h or x >= self._w:
+            raise curses.error('wmove() returned ERR')
+        self._cy = y
+        self._cx = x
+
+    def _put(self, text, attr):
+        # Write at the cursor, wrapping at the right edge like curses does.
+        # Running off the bottom-right corner is an error, the characters
+        # that fit are still written.
+
+        a = attr << CHAR_BITS
+        y, x = self._cy, self._cx
+        row = self._rows[self._oy + y]
+        self._touched.add(y)
+
+        if TextWidth.is_simple(text) and x + len(text) < self._w:
+            start = self._ox + x
+            row[start:start+len(text)] = array.array('Q', [c | a for c in text.encode('ascii')])
+            self._cx = x + len(text)
+            return
+
+        for ch in text:
+            if ch == '\n':
+                start = self._ox + x
+                row[start:self._ox+self._w] = array.array('Q', [BLANK]) * (self._w - x)
+                x = self._w
+            else:
+                cw = TextWidth.char_width(ch)
+                if cw == 0:
+                    continue
+                if x + cw > self._w:
+                    x = self._w
+                else:
+                    row[self._ox + x] = ord(ch) | a
+                    if cw == 2:
+                        row[self._ox + x + 1] = a
+                    x += cw
+                    if x < self._w:
+                        continue
+            # next line
+            if y + 1 >= self._h:
+                self._cy, self._cx = y, self._w - 1
+                raise curses.error('addwstr() returned ERR')
+            y += 1
+            x = 0
+            row = self._rows[self._oy + y]
+            self._touched.add(y)
+        self._cy, self._cx = y, x
+
+    def addstr(self, *args):
+        # addstr([y, x,] text[, attr])
+        if isinstance(args[0], str):
+            text = args[0]
+            attr = args[1] if len(args) > 1 else 0
+        else:
+            self.move(args[0], args[1])
+            text = args[2]
+            attr = args[3] if len(args) > 3 else 0
+        self._put(text, attr)
+
+    def addch(self, *args):
+        # addch([y, x,] ch[, attr])
+        if len(args) >= 3:
+            self.move(args[0], args[1])
+            args = args[2:]
+        ch = args[0]
+        attr = args[1] if len(args) > 1 else 0
+        if isinstance(ch, int):
+            cell = _cell(ch, attr)
+            ch = chr(cell & CHAR_MASK)
+            attr = cell >> CHAR_BITS
+        self._put(ch, attr)
+
+    def _line(self, args):
+        # [y, x,] ch, n
+        if len(args) == 4:
+            self.move(args[0], args[1])
+            args = args[2:]
+        return _cell(args[0], 0), args[1]
+
+    def hline(self, *args):
+        # Doesn't move the cursor or wrap
+        cell, n = self._line(args)
+        n = max(0, min(n, self._w - self._cx))
+        start = self._ox + self._cx
+        self._rows[self._oy + self._cy][start:start+n] = array.array('Q', [cell]) * n
+        self._touched.add(self._cy)
+
+    def vline(self, *args):
+        cell, n = self._line(args)
+        x = self._ox + self._cx
+        for y in range(self._cy, min(self._h, self._cy + n)):
+            self._rows[self._oy + y][x] = cell
+            self._touched.add(y)
+
+    def border(self, ls=0, rs=0, ts=0, bs=0, tl=0, tr=0, bl=0, br=0):
+        # 0 picks the default character, like in curses
+        ls, rs = ls or ord('|'), rs or ord('|')
+        ts, bs = ts or ord('-'), bs or ord('-')
+        tl, tr, bl, br = tl or ord('+'), tr or ord('+'), bl or ord('+'), br or ord('+')
+        h, w = self._h, self._w
+        cy, cx = self._cy, self._cx
+        self.hline(0, 0, ts, w)
+        self.hline(h-1, 0, bs, w)
+        self.vline(0, 0, ls, h)
+        self.vline(0, w-1, rs, h)
+        for y, x, c in ((0, 0, tl), (0, w-1, tr), (h-1, 0, bl), (h-1, w-1, br)):
+            self._rows[self._oy + y][self._ox + x] = _cell(c, 0)
+        self._cy, self._cx = cy, cx
+
+    def erase(self):
+        blank = array.array('Q', [BLANK]) * self._w
+        for y in range(self._oy, self._oy + self._h):
+            self._rows[y][self._ox:self._ox+self._w] = blank
+        self._cy = self._cx = 0
+        self.touchwin()
+
+    def clear(self):
+        # Like erase(), and the whole screen is repainted on the next update
+        self.erase()
+        self._backend.clear_screen = True
+
+    def instr(self, y, x, n=None):
+        if n is None:
+            n = self._w - x
+        row = self._rows[self._oy + y]
+        start = self._ox + x
+        return ''.join(chr(c & CHAR_MASK) for c in row[start:start+n] if c & CHAR_MASK).encode('utf-8')
+
+    def noutrefresh(self):
+        for y in self._touched:
+            self._backend.copy(self._rows, self._oy + y, self._ox, self._by + y, self._bx, 1, self._w)
+        self._touched = set()
+        self._backend.cursor = (self._by + self._cy, self._bx + self._cx)
+
+    def refresh(self):
+        self.noutrefresh()
+        self._backend.doupdate()
+
+    def getch(self):
+        return self._backend.getch()
+
+    def touchwin(self):
+        self._touched = set(range(self._h))
+
+    def touchline(self, start, count, changed=True):
+        rows = range(max(0, start), min(self._h, start + count))
+        if changed:
+            self._touched.update(rows)
+        else:
+            self._touched.difference_update(rows)
+
+    # Settings that don't matter without a terminal
+
+    def leaveok(self, flag):
+        pass
+
+    def scrollok(self, flag):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+class Pad(Window):
+
+    def __init__(self, backend, h, w):
+        Window.__init__(self, backend, _blank_rows(h, w), 0, 0, h, w, 0, 0)
+
+    def noutrefresh(self, pminrow, pmincol, sminrow, smincol, smaxrow, smaxcol):
+        h = min(smaxrow - sminrow + 1, self._h - pminrow)
+        w = min(smaxcol - smincol + 1, self._w - pmincol)
+        for y in range(pminrow, pminrow + h):
+            if y in self._touched:
+                self._backend.copy(self._rows, self._oy + y, self._ox + pmincol, sminrow + y - pminrow, smincol, 1, w)
+                self._touched.discard(y)
+
+    def refresh(self, *args):
+        self.noutrefresh(*args)
+        self._backend.doupdate()
+
+class Backend:
+    # Screen backend for UIEngine.Canvas. Windows are copied into the virtual
+    # screen on noutrefresh() and doupdate() makes it the physical one, like
+    # in curses.
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cursor = (0, 0)
+        self.clear_screen = False
+        self.keys = collections.deque() # keys for getch()
+        self.updates = 0 # amount of doupdate() calls
+        self.frame_bytes = None # nothing is written anywhere
+
+        self._virtual = _blank_rows(rows, cols)
+        self._physical = _blank_rows(rows, cols)
+        self.screen = Window(self, _blank_rows(rows, cols), 0, 0, rows, cols, 0, 0)
+
+    def run(self, fn):
+        return fn(self.screen)
+
+    def start(self, screen):
+        pass
+
+    def stop(self):
+        pass
+
+    def on_resize(self):
+        pass
+
+    def newpad(self, h, w):
+        return Pad(self, h, w)
+
+    def color_pair(self, n):
+        return n << 8
+
+    def init_pair(self, n, fg, bg):
+        pass
+
+    def copy(self, rows, oy, ox, y, x, h, w):
+        # Copy a h*w block of rows at (oy, ox) to the virtual screen at (y, x)
+        if y < 0 or x < 0:
+            return
+        h = min(h, self.rows - y)
+        w = min(w, self.cols - x)
+        for i in range(h):
+            self._virtual[y+i][x:x+w] = rows[oy+i][ox:ox+w]
+
+    def doupdate(self):
+        self.updates += 1
+        for y in range(self.rows):
+            if self._virtual[y] != self._physical[y]:
+                self._physical[y] = array.array('Q', self._virtual[y])
+        self.clear_screen = False
+
+    def resize(self, rows, cols):
+        # Like curses.resizeterm(). The screen window keeps its identity,
+        # windows derived from it see the new rows. Call Canvas.on_resize()
+        # afterwards, as the SIGWINCH handler would.
+        for grid in (self._virtual, self._physical, self.screen._rows):
+            del grid[rows:]
+            for row in grid:
+                if len(row) > cols:
+                    del row[cols:]
+                else:
+                    row.extend(array.array('Q', [BLANK]) * (cols - len(row)))
+            grid.extend(_blank_rows(rows - len(grid), cols))
+        self.rows = rows
+        self.cols = cols
+        self.screen._h = rows
+        self.screen._w = cols
+        self.screen._cy = min(self.screen._cy, rows-1)
+        self.screen._cx = min(self.screen._cx, cols-1)
+        self.screen.touchwin()
+
+    def feed(self, keys):
+        # Queue keys for getch(), text is fed as its UTF-8 bytes
+        if isinstance(keys, str):
+            keys = keys.encode('utf-8')
+        if isinstance(keys, int):
+            keys = [keys]
+        self.keys.extend(keys)
+
+    def getch(self):
+        if len(self.keys) == 0:
+            return -1
+        return self.keys.popleft()
+
+    def snapshot(self):
+        # The physical screen as text, one string per row
+        return [''.join(chr(c & CHAR_MASK) for c in row if c & CHAR_MASK) for row in self._physical]
+
+    def cell(self, y, x):
+        # (character, attributes) on the physical screen
+        c = self._physical[y][x]
+        return (chr(c & CHAR_MASK), c >> CHAR_BITS)
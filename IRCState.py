@@ -1,9 +1,17 @@
 import ProtobufSocket
+import Completion
+import EventBus
+import Stats
 import protocol_pb2 as proto
 
 class Buffer:
     def __init__(self, buffer):
         self.id = buffer.id
+        # nicks seen in the buffer, for completion
+        self.nicks = Completion.PrefixIndex()
+        self.update(buffer)
+
+    def update(self, buffer):
         self.type = buffer.role.buffer_type
         self.name = buffer.role.name
 
@@ -13,12 +21,14 @@ class Network:
     STATE_CONNECTING = 1
     STATE_CONNECTED = 2
 
-    def __init__(self, networkdef, methods):
+    def __init__(self, networkdef):
         self.id = networkdef.id
         self.buffers = {}
         self.state = 0
+        # None: not loaded yet, False: the network is not configured
         self.configuration = None
-        self.methods = methods
+        # bumped on every change, views use it to tell when to rebuild
+        self.version = 0
 
         if networkdef.state == proto.NetworkListT.NetworkDisconnected:
             self.state = Network.STATE_DISCONNECTED
@@ -30,42 +40,62 @@ class Network:
 
     def add_buffer(self, buffer):
 
-        self.buffers[buffer.id] = Buffer(buffer)
+        # A buffer listed again keeps what's known about it, like its nicks
+        if buffer.id in self.buffers:
+            self.buffers[buffer.id].update(buffer)
+        else:
+            self.buffers[buffer.id] = Buffer(buffer)
+        self.version += 1
 
     def buffer_list(self):
-        return sorted([v for k, v in self.buffers.items()])
+        return sorted(self.buffers.values(), key=lambda buffer: buffer.id)
 
     def get_state(self):
         return self.state
+
+    def set_state(self, state):
+        self.state = state
+        self.version += 1
+
     def get_configuration(self):
-        if self.configuration == None:
-            m = 'get_configuration'
-            if m in self.methods:
-                method = self.methods[m]
-                del self.methods[m]
-                method()
-            return None
+        # Only returns the cached value, IRCState takes care of loading it
         return self.configuration
 
+    def set_configuration(self, configuration):
+        self.configuration = configuration
+        self.version += 1
+
+    def invalidate_configuration(self):
+        self.set_configuration(None)
+
 class IRCState:
 
-    def __init__(self, hostport, callbacks):
+    def __init__(self, hostport, bus, stats=None):
 
         self.networks = dict()
+        self.stats = stats if stats is not None else Stats.Stats()
+
+        # ids of networks with a GetNetworkConfiguration request in flight
+        self.pending_configurations = set()
 
-        self.logger = callbacks['logger']
-        self.callbacks = callbacks
+        self.bus = bus
+        self.subscriptions = [
+            bus.subscribe(EventBus.SocketConnected, self.on_connect),
+            bus.subscribe(EventBus.SocketClosed, self.on_close),
+            bus.subscribe(EventBus.SocketMessage, self.on_message),
+        ]
 
-        self.socket = ProtobufSocket.ProtobufSocket(hostport, callbacks={
+        self.socket = ProtobufSocket.ProtobufSocket(hostport, bus, self.stats)
 
-            'logger': lambda x: self.logger('PROTO: ' + x),
-            'connect': self.on_connect,
-            'close': self.on_close,
-            'message': self.on_message
-        })
+    def logger(self, msg):
+        self.bus.publish(EventBus.Log(msg))
 
+    def close(self):
+        for sub in self.subscriptions:
+            self.bus.unsubscribe(sub)
+        self.subscriptions = []
 
-    def on_connect(self):
+    def on_connect(self, event):
         def attach_session_result(success):
             if success:
                     self.socket.get_network_list(self.on_network_list)
@@ -73,39 +103,61 @@ class IRCState:
                 self.logger('Unable to attach session!')
 
         self.socket.attach_session(0, attach_session_result)
-        self.callbacks['core_connect']()
+        self.bus.publish(EventBus.CoreConnected())
 
-    def on_close(self):
-        self.callbacks['core_close']()
+    def on_close(self, event):
+        self.bus.publish(EventBus.CoreClosed())
 
     def network_list(self):
-        return sorted([v for k, v in self.networks.items()])
+        return sorted(self.networks.values(), key=lambda network: network.id)
 
     def on_network_list(self, network_list):
 
         for network in network_list:
             if network.id not in self.networks:
-                self.networks[network.id] = Network(network, {
-                    'get_configuration': lambda: self.socket.get_network_configuration(network.id, self.on_network_configuration)
-                })
+                self.networks[network.id] = Network(network)
 
-        self.callbacks['core_networklist'](self.network_list())
+        self.bus.publish(EventBus.NetworkListChanged(self.network_list()))
+
+        self.fetch_configurations()
 
         # Refresh buffers
         for id in self.networks:
             self.socket.get_buffer_list(id, self.on_buffer_list)
 
+    def fetch_configurations(self, networks=None):
+        # Prefetch the configuration of every network that doesn't have one
+        # cached yet. Failed requests leave the cache empty, so the next call
+        # retries them.
+
+        if networks is None:
+            networks = self.networks.values()
+
+        for network in networks:
+            if network.configuration is not None:
+                continue
+            if network.id in self.pending_configurations:
+                continue
+            self.pending_configurations.add(network.id)
+            self.socket.get_network_configuration(network.id, self.on_network_configuration)
+
     def on_network_configuration(self, network_id, network_configuration):
 
+        self.pending_configurations.discard(network_id)
+
         if not network_id in self.networks:
             self.logger('Received network configuration for an unknown network')
             return
 
+        if network_configuration is None:
+            self.logger('Unable to load configuration for network ' + str(network_id))
+            return
+
         network = self.networks[network_id]
-        network.configuration = network_configuration
+        network.set_configuration(network_configuration)
 
-        # TODO: Use narrower callback
-        self.callbacks['core_networklist'](self.network_list())
+        # TODO: Use narrower event
+        self.bus.publish(EventBus.NetworkListChanged(self.network_list()))
 
     def on_buffer_list(self, network_id, buffer_list):
 
@@ -118,9 +170,12 @@ class IRCState:
         for buffer in buffer_list:
             network.add_buffer(buffer)
 
-        self.callbacks['core_bufferlist'](network)
+        self.bus.publish(EventBus.BufferListChanged(network))
+
+    def on_message(self, event):
 
-    def on_message(self, packet):
+        packet = event.packet
+        self.stats.messages.add()
 
         try:
 
@@ -137,7 +192,7 @@ class IRCState:
                 network = self.networks[network_id]
                 network.add_buffer(packet.new_buffer)
 
-                self.callbacks['core_newbuffer'](network)
+                self.bus.publish(EventBus.NewBuffer(network))
 
             elif type == proto.RemoteMessage.Information:
 
@@ -149,6 +204,24 @@ class IRCState:
                 msg = packet.information.msg
                 self.logger('Information: ' + msg)
 
+            elif type == proto.RemoteMessage.Join:
+
+                buffer = self.find_buffer(packet, 'Join')
+                if buffer is None:
+                    return
+                who = packet.join.who
+                buffer.nicks.touch(who)
+                self.bus.publish(EventBus.BufferMessage(self.networks[packet.network_id], buffer, who + ' has joined ' + buffer.name))
+
+            elif type == proto.RemoteMessage.Privmsg:
+
+                buffer = self.find_buffer(packet, 'Privmsg')
+                if buffer is None:
+                    return
+                who = packet.privmsg.who
+                buffer.nicks.touch(who)
+                self.bus.publish(EventBus.BufferMessage(self.networks[packet.network_id], buffer, '<' + who + '> ' + packet.privmsg.msg))
+
             elif type == proto.RemoteMessage.Connected:
                 network_id = packet.network_id
                 if not network_id in self.networks:
@@ -156,8 +229,9 @@ class IRCState:
                     return
 
                 network = self.networks[network_id]
-                network.state = Network.STATE_CONNECTED
-                self.callbacks['core_networklist'](self.network_list())
+                network.set_state(Network.STATE_CONNECTED)
+                self.fetch_configurations([network])
+                self.bus.publish(EventBus.NetworkListChanged(self.network_list()))
 
             elif type == proto.RemoteMessage.Disconnected:
 
@@ -167,8 +241,8 @@ class IRCState:
                     return
 
                 network = self.networks[network_id]
-                network.state = Network.STATE_DISCONNECTED
-                self.callbacks['core_networklist'](self.network_list())
+                network.set_state(Network.STATE_DISCONNECTED)
+                self.bus.publish(EventBus.NetworkListChanged(self.network_list()))
 
             else:
                 self.logger('Received unhandled message of type: ' + str(type))
@@ -177,6 +251,18 @@ class IRCState:
         except Exception as e:
             self.logger('exception: ' + str(e))
 
+    def find_buffer(self, packet, what):
+        # Buffer a message is for, None if it isn't known
+
+        if not packet.network_id in self.networks:
+            self.logger('Received ' + what + ' for an unknown network')
+            return None
+
+        buffer = self.networks[packet.network_id].buffers.get(packet.buffer_id)
+        if buffer is None:
+            self.logger('Received ' + what + ' for an unknown buffer')
+        return buffer
+
     def core_connect(self, network_or_id, address):
 
         id = network_or_id
@@ -184,3 +270,26 @@ class IRCState:
             id = network_or_id.id
 
         self.socket.send_connect(id, address)
+
+    def set_network_configuration(self, network_or_id, server, nickname):
+
+        id = network_or_id
+        if type(network_or_id) is Network:
+            id = network_or_id.id
+
+        def set_configuration_result(network_id, success):
+            if not success:
+                self.logger('Unable to set configuration for network ' + str(network_id))
+                return
+            if not network_id in self.networks:
+                return
+
+            # The cached copy is stale now, reload it from the core
+            network = self.networks[network_id]
+            network.invalidate_configuration()
+            self.pending_configurations.discard(network_id)
+            self.fetch_configurations([network])
+
+            self.bus.publish(EventBus.NetworkListChanged(self.network_list()))
+
+        self.socket.set_network_configuration(id, server, nickname, set_configuration_result)
@@ -1,6 +1,8 @@
 import asyncore, socket
 import struct
 import protocol_pb2 as proto
+import EventBus
+import Stats
 import traceback
 import socket
 import sys
@@ -11,25 +13,21 @@ STATUS_DISCONNECTED = 2
 
 class ProtobufSocket(asyncore.dispatcher):
 
-    def __init__(self, hostport, callbacks):
+    def __init__(self, hostport, bus, stats=None):
         asyncore.dispatcher.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.callbacks = callbacks
+        self.bus = bus
+        self.stats = stats if stats is not None else Stats.Stats()
         self.in_buffer = bytearray()
         self.out_buffer = bytearray()
 
-        self.logger = self.callbacks['logger']
-        self.on_connect = self.callbacks['connect']
-        self.on_close = self.callbacks['close']
-        self.on_message = self.callbacks['message']
-
         self.logger('Connecting to %s:%s' % hostport)
 
         self.status = STATUS_CONNECTING
 
         # used to differentiate responses in the protocol
         self.tag_number = 0
-        self.callbacks = dict()
+        self.requests = dict() # tag -> response callback
 
         try:
             self.connect(hostport)
@@ -42,6 +40,9 @@ class ProtobufSocket(asyncore.dispatcher):
         except Exception as e:
             self.logger(e)
 
+    def logger(self, msg):
+        self.bus.publish(EventBus.Log('PROTO: ' + str(msg)))
+
     def handle_error(self):
         self.logger(traceback.format_exc())
         self.close()
@@ -49,13 +50,13 @@ class ProtobufSocket(asyncore.dispatcher):
     def handle_connect(self):
         try:
             self.status = STATUS_CONNECTED
-            self.on_connect()
+            self.bus.publish(EventBus.SocketConnected())
         except Exception as e:
             self.logger('handle_connect: ' + str(e))
 
     def handle_close(self):
         self.status = STATUS_DISCONNECTED
-        self.on_close()
+        self.bus.publish(EventBus.SocketClosed())
         self.close()
 
     def writable(self):
@@ -63,7 +64,9 @@ class ProtobufSocket(asyncore.dispatcher):
 
     def handle_read(self):
 
-        self.in_buffer += self.recv(8192)
+        data = self.recv(8192)
+        self.stats.bytes_in.add(len(data))
+        self.in_buffer += data
 
         # each packet begins with a 4-byte little-endian u32 denoting its length
         header_length = 4
@@ -85,6 +88,7 @@ class ProtobufSocket(asyncore.dispatcher):
 
                 remote_message = proto.RemoteMessage()
                 remote_message.ParseFromString(bytes(raw_blob))
+                self.stats.frames_in.add()
 
                 if not remote_message.IsInitialized():
                     self.logger('Server bug? Received invalid message: len=' + str(body_length) + ' ' + str(raw_blob))
@@ -92,13 +96,13 @@ class ProtobufSocket(asyncore.dispatcher):
 
                 self.logger("<<< " + str(remote_message))
 
-                if remote_message.HasField('tag') and remote_message.tag in self.callbacks:
+                if remote_message.HasField('tag') and remote_message.tag in self.requests:
 
-                    callback = self.callbacks[remote_message.tag]
-                    del self.callbacks[remote_message.tag]
+                    callback = self.requests[remote_message.tag]
+                    del self.requests[remote_message.tag]
                     callback(remote_message)
                 else:
-                    self.on_message(remote_message)
+                    self.bus.publish(EventBus.SocketMessage(remote_message))
 
         except Exception as e:
             self.logger('exception: ' + str(e))
@@ -108,6 +112,7 @@ class ProtobufSocket(asyncore.dispatcher):
             return
 
         sent = self.send(self.out_buffer)
+        self.stats.bytes_out.add(sent)
         self.out_buffer = self.out_buffer[sent:]
 
     #def handle_error(self):
@@ -124,7 +129,7 @@ class ProtobufSocket(asyncore.dispatcher):
             return
 
         if cb is not None:
-            self.callbacks[self.tag_number] = cb
+            self.requests[self.tag_number] = cb
 
         packet.tag = self.tag_number
         self.tag_number = (self.tag_number + 1) % 100000
@@ -191,10 +196,30 @@ class ProtobufSocket(asyncore.dispatcher):
                     cb(packet.network_id, False)
             else:
                 self.logger('Unknown reply to GetNetworkConfiguration: '+str(packet))
+                # None tells the caller nothing was loaded, so it may retry later
+                cb(network_id, None)
+
+        self.write_packet(packet, handle_response)
+
+    def set_network_configuration(self, network_id, server, nickname, cb):
+        packet = proto.RemoteCommand()
+        packet.packet_type = proto.RemoteCommand.SetNetworkConfiguration
+        packet.network_id = network_id
+        packet.set_network_configuration.server = server
+        packet.set_network_configuration.nickname = nickname
+
+        def handle_response(packet):
+            if packet.packet_type == proto.RemoteMessage.Error:
+                cb(network_id, False)
+            elif packet.packet_type == proto.RemoteMessage.Success:
+                cb(network_id, True)
+            else:
+                self.logger('Unknown reply to SetNetworkConfiguration: '+str(packet))
+                cb(network_id, False)
 
         self.write_packet(packet, handle_response)
 
-    def send_connect(self, network_id, address):
+    def send_connect(self, network_id, address, cb=None):
         packet = proto.RemoteCommand()
         packet.packet_type = proto.RemoteCommand.Connect
         packet.network_id = network_id
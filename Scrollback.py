@@ -0,0 +1,221 @@
+import array
+import os
+import tempfile
+
+def _source(line):
+    # Text a line is stored as, formatted lines keep their codes
+    return line.raw if line.raw is not None else line.text
+
+class RingBuffer:
+    # Fixed capacity list, appending to a full buffer replaces the oldest item
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = []
+        self._head = 0 # index of the oldest item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        n = len(self._items)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError('RingBuffer index out of range')
+        return self._items[(self._head + i) % self.capacity]
+
+    def __iter__(self):
+        for i in range(len(self._items)):
+            yield self[i]
+
+    def append(self, item):
+        # Returns the item that fell out, or None
+        if len(self._items) < self.capacity:
+            self._items.append(item)
+            return None
+        old = self._items[self._head]
+        self._items[self._head] = item
+        self._head = (self._head + 1) % self.capacity
+        return old
+
+
+class Scrollback:
+    # Lines of a window. Only the newest max_lines are kept in memory, older
+    # ones are spilled to an append-only file and paged back in on request.
+    #
+    # Indexing goes over the lines in view: the pages loaded from the spill
+    # file followed by the lines in memory. At most max_paged lines are
+    # paged in. Past that, paged lines are dropped around the ones the
+    # owner asks to keep (the lines on screen): the oldest ones above them,
+    # or the newest ones below them. In the latter case the view stops
+    # following new lines and ends with the pages, newer ones are read back
+    # when scrolling down to them.
+
+    # Lines per page when reading back from the spill file
+    PAGE_LINES = 256
+
+    def __init__(self, max_lines, make_line):
+        self.make_line = make_line # text -> line object, for paged in lines
+        self._ring = RingBuffer(max_lines)
+        self._paged = [] # lines paged back in, they precede the ring
+        self.max_paged = max(max_lines, 2 * Scrollback.PAGE_LINES)
+        self._paged_first = 0 # number of the first paged line
+        self._following = True # whether the ring is in view after the pages
+        self._keep = (0, 0) # numbers of the lines not to drop, see keep()
+
+        self._file = None
+        self._file_end = 0
+        self._spilled = 0 # amount of lines in the spill file
+        self._page_offsets = array.array('Q') # file offset of each page
+
+    def __len__(self):
+        if not self._following:
+            return len(self._paged)
+        return len(self._paged) + len(self._ring)
+
+    def __getitem__(self, i):
+        n = len(self._paged)
+        if i < 0:
+            i += len(self)
+        if i < n:
+            return self._paged[i]
+        if not self._following:
+            raise IndexError('Scrollback index out of range')
+        return self._ring[i - n]
+
+    def first(self):
+        # Number of the first line in view, counted from the very first line
+        if len(self._paged) == 0:
+            return self._spilled
+        return self._paged_first
+
+    def following(self):
+        # Whether new lines come into view
+        return self._following
+
+    def keep(self, start, stop):
+        # Don't drop the lines start...stop-1 to stay within max_paged
+        self._keep = (start, stop)
+
+    def total(self):
+        # Amount of lines ever appended
+        return self._spilled + len(self._ring)
+
+    def append(self, line):
+        # Returns the amount of lines that fell out of view
+
+        old = self._ring.append(line)
+        if old is not None:
+            self._spill(old)
+        if old is None or not self._following:
+            return 0
+
+        # With pages loaded the view has to stay contiguous
+        if len(self._paged) > 0:
+            self._paged.append(old)
+            excess = len(self._paged) - self.max_paged
+            excess -= self._drop_newest(excess)
+            return self._drop_oldest(excess)
+        return 1
+
+    def _drop_newest(self, n):
+        # Drop up to n paged lines below the kept ones, the view then ends
+        # with the pages. Returns the amount dropped.
+        end = self._paged_first + len(self._paged)
+        n = min(n, end - max(self._keep[1], self._paged_first))
+        if n <= 0:
+            return 0
+        del self._paged[-n:]
+        self._following = False
+        return n
+
+    def _drop_oldest(self, n):
+        # Drop up to n paged lines above the kept ones, returns the amount
+        n = min(n, self._keep[0] - self._paged_first)
+        if n <= 0:
+            return 0
+        del self._paged[:n]
+        self._paged_first += n
+        return n
+
+    def _spill(self, line):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile()
+
+        if self._spilled % Scrollback.PAGE_LINES == 0:
+            self._page_offsets.append(self._file_end)
+
+        # make_line parses formatted lines again when they're paged back in
+        data = _source(line).encode('utf-8', 'replace') + b'\n'
+        self._file.seek(self._file_end)
+        self._file.write(data)
+        self._file_end += len(data)
+        self._spilled += 1
+
+    def can_page_in(self):
+        return self.first() > 0
+
+    def has_pages(self):
+        return len(self._paged) > 0
+
+    def page_in(self):
+        # Load the lines of the page preceding the view, returns their amount
+
+        first = self.first()
+        if first == 0:
+            return 0
+
+        start = (first - 1) // Scrollback.PAGE_LINES * Scrollback.PAGE_LINES
+        self._paged[0:0] = self._read(start, first)
+        self._paged_first = start
+        self._drop_newest(len(self._paged) - self.max_paged)
+        return first - start
+
+    def page_down(self):
+        # Load the lines of the page following the view when it doesn't
+        # follow new lines, returns the amount of lines dropped at the top
+
+        end = self._paged_first + len(self._paged)
+        stop = min(self._spilled, (end // Scrollback.PAGE_LINES + 1) * Scrollback.PAGE_LINES)
+        self._paged.extend(self._read(end, stop))
+        if stop == self._spilled:
+            self._following = True
+        return self._drop_oldest(len(self._paged) - self.max_paged)
+
+    def _read(self, start, stop):
+        # Lines start...stop-1 from the spill file
+        page = start // Scrollback.PAGE_LINES
+        self._file.flush()
+        self._file.seek(self._page_offsets[page])
+        for _ in range(start - page * Scrollback.PAGE_LINES):
+            self._file.readline()
+        lines = []
+        for _ in range(stop - start):
+            text = self._file.readline()[:-1].decode('utf-8', 'replace')
+            lines.append(self.make_line(text))
+        return lines
+
+    def release_pages(self):
+        # Forget the paged in lines and follow new lines again, returns the
+        # amount of lines paged in
+        n = len(self._paged)
+        self._paged = []
+        self._following = True
+        return n
+
+    def snapshot(self):
+        # Every line appended so far, for reading on another thread while
+        # lines keep being appended: (fd, size, texts). The spilled lines
+        # are the first size bytes of the file fd, read them with os.pread()
+        # and close fd when done. texts are the lines in memory after them.
+        fd = None
+        if self._file is not None:
+            self._file.flush()
+            fd = os.dup(self._file.fileno())
+        return fd, self._file_end, [_source(line) for line in self._ring]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,84 @@
+import functools
+import os
+import threading
+import time
+
+import Formatting
+
+class Search:
+    # A regex search over a Scrollback.snapshot() on a thread of its own.
+    # The thread only reads the snapshot: matches are handed to the UI loop
+    # in batches through post (EventLoop.call_soon_threadsafe), so
+    # on_results(search, texts) and on_done(search, matches, lines,
+    # cancelled) run on the loop thread and the UI keeps drawing meanwhile.
+
+    # Bytes of the spill file read at a time, cancel() is noticed between
+    # reads
+    CHUNK = 1 << 20
+    # Matches are handed over once there are this many, or after INTERVAL
+    # seconds
+    BATCH = 500
+    INTERVAL = 0.05
+
+    def __init__(self, regex, snapshot, post, on_results, on_done):
+        self.regex = regex
+        self._fd, self._size, self._texts = snapshot
+        self._post = post
+        self._on_results = on_results
+        self._on_done = on_done
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def stop(self):
+        # Cancel and wait for the thread, before the loop it posts to closes
+        self.cancel()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _chunks(self):
+        # Lists of line texts: the spilled ones, then the ones in memory
+        offset = 0
+        rest = b''
+        while self._fd is not None and offset < self._size:
+            data = os.pread(self._fd, min(Search.CHUNK, self._size - offset), offset)
+            if len(data) == 0:
+                break
+            offset += len(data)
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            yield [line.decode('utf-8', 'replace') for line in lines]
+        yield self._texts
+
+    def _run(self):
+        search = self.regex.search
+        found = []
+        matches = 0
+        lines = 0
+        last = time.monotonic()
+        try:
+            for chunk in self._chunks():
+                if self._cancelled.is_set():
+                    break
+                for text in chunk:
+                    if search(Formatting.strip(text)):
+                        found.append(text)
+                lines += len(chunk)
+
+                if len(found) >= Search.BATCH or (len(found) > 0 and time.monotonic() - last >= Search.INTERVAL):
+                    matches += len(found)
+                    self._post(functools.partial(self._on_results, self, found))
+                    found = []
+                    last = time.monotonic()
+        finally:
+            if self._fd is not None:
+                os.close(self._fd)
+            if len(found) > 0 and not self._cancelled.is_set():
+                matches += len(found)
+                self._post(functools.partial(self._on_results, self, found))
+            self._post(functools.partial(self._on_done, self, matches, lines, self._cancelled.is_set()))
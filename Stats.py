@@ -0,0 +1,71 @@
+import collections
+import math
+import time
+
+# Counters for the performance HUD. They are cheap enough to update on
+# every packet and frame, the rates and percentiles are only computed when
+# the HUD is drawn.
+
+class Rate:
+    # Running total and the amount per second, over the last full second
+
+    def __init__(self):
+        self.total = 0
+        self._second = int(time.monotonic())
+        self._count = 0 # during self._second
+        self._last = 0 # during the second before
+
+    def add(self, n=1):
+        self._roll()
+        self._count += n
+        self.total += n
+
+    def _roll(self):
+        now = int(time.monotonic())
+        if now != self._second:
+            self._last = self._count if now == self._second + 1 else 0
+            self._count = 0
+            self._second = now
+
+    def per_second(self):
+        self._roll()
+        return self._last
+
+class Timing:
+    # Durations of something that happens once per frame at most
+
+    # Amount of durations kept for the percentile
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.last = 0.0 # 0 when it didn't happen on the last frame
+        self._samples = collections.deque(maxlen=Timing.SAMPLES)
+
+    def add(self, seconds):
+        self.last = seconds
+        self._samples.append(seconds)
+
+    def skip(self):
+        self.last = 0.0
+
+    def percentile(self, p):
+        if len(self._samples) == 0:
+            return 0.0
+        # Nearest rank
+        samples = sorted(self._samples)
+        return samples[max(0, math.ceil(p * len(samples)) - 1)]
+
+class Stats:
+
+    def __init__(self):
+        self.frames_in = Rate() # packets decoded from the core
+        self.bytes_in = Rate()
+        self.bytes_out = Rate()
+        self.messages = Rate() # messages applied by IRCState
+        self.redraws = Rate()
+        self.panels = dict() # panel id -> Timing
+
+    def panel(self, panel_id):
+        if panel_id not in self.panels:
+            self.panels[panel_id] = Timing()
+        return self.panels[panel_id]
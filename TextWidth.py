@@ -0,0 +1,102 @@
+import functools
+import unicodedata
+
+# Terminal cell widths of text. Most text is ASCII, which always takes one
+# cell per character, so that's checked first and the per-character lookups
+# are only done for the rest.
+
+@functools.lru_cache(maxsize=4096)
+def char_width(c):
+    if unicodedata.combining(c):
+        return 0
+    category = unicodedata.category(c)
+    if category == 'Mn' or category == 'Me' or category == 'Cf':
+        return 0
+    if category == 'Cc':
+        return 2 # curses shows control characters as ^X
+    if unicodedata.east_asian_width(c) in ('W', 'F'):
+        return 2
+    return 1
+
+def is_simple(s):
+    # Whether every character of s takes exactly one cell
+    return s.isascii() and s.isprintable()
+
+def width(s):
+    if is_simple(s):
+        return len(s)
+    return sum(map(char_width, s))
+
+@functools.lru_cache(maxsize=1024)
+def truncate(s, w):
+    # Longest prefix of s that fits in w cells
+    if is_simple(s):
+        return s[:max(0, w)]
+    cells = 0
+    for i in range(len(s)):
+        cells += char_width(s[i])
+        if cells > w:
+            return s[:i]
+    return s
+
+def pad(s, w):
+    # s truncated or padded with spaces to exactly w cells
+    s = truncate(s, w)
+    return s + ' ' * (w - width(s))
+
+def column(s, idx):
+    # Cell where character idx of s begins
+    return width(s[:idx])
+
+def wrap(s, w):
+    # Offsets where the rows of s wrapped to w cells begin. A wide character
+    # that doesn't fit on a row moves to the next one.
+    if is_simple(s):
+        return range(0, len(s), w)
+
+    breaks = []
+    cells = 0
+    for i in range(len(s)):
+        cw = char_width(s[i])
+        if i == 0 or cells + cw > w:
+            breaks.append(i)
+            cells = 0
+        cells += cw
+    return breaks
+
+
+class Line:
+    # A line of text that remembers its width and the wrap offsets for the
+    # last width it was wrapped to. Formatted lines (see Formatting) also
+    # have the attribute spans of the text and the text they were parsed
+    # from.
+
+    __slots__ = ('text', 'width', 'simple', 'spans', 'raw', '_wrap_width', '_breaks')
+
+    def __init__(self, text, spans=None, raw=None):
+        self.text = text
+        self.spans = spans
+        self.raw = raw
+        self.simple = is_simple(text)
+        self.width = len(text) if self.simple else width(text)
+        self._wrap_width = 0
+        self._breaks = None
+
+    def breaks(self, w):
+        if self.simple:
+            return range(0, len(self.text), w)
+        if self._wrap_width != w:
+            self._breaks = wrap(self.text, w)
+            self._wrap_width = w
+        return self._breaks
+
+    def rows(self, w):
+        if self.simple:
+            return (len(self.text) + w - 1) // w
+        return len(self.breaks(w))
+
+    def row(self, w, i):
+        # Text of wrapped row i
+        breaks = self.breaks(w)
+        end = breaks[i+1] if i+1 < len(breaks) else len(self.text)
+        return self.text[breaks[i]:end]
@@ -1,13 +1,32 @@
-import threading
+import bisect
 import curses
 import re
+import signal
+import sys
 
 from IRCState import IRCState
+import Commands
+import EventBus
+import EventLoop
+import Search
+import Stats
 import UIComponents
 import UIEngine
+import TextWidth
+
+def format_bytes(n):
+    for unit in ('B', 'K', 'M'):
+        if n < 1024:
+            return '%d%s' % (n, unit)
+        n //= 1024
+    return '%dG' % n
 
 class IRCUI:
 
+    # Most candidates offered by one Tab completion
+    COMPLETIONS = 50
+    # Event handlers shown in the stats panel, the slowest ones in total
+    STATS_HANDLERS = 5
 
     LAYOUTS = {
         'default': '''
@@ -49,53 +68,128 @@ ver(
 
     }
 
-    def __init__(self):
+    def __init__(self, backend=None):
+
+        self.loop = EventLoop.EventLoop(logger=self.log_exception)
+        self.bus = EventBus.EventBus()
+        self.stats = Stats.Stats()
+        self.state = None
 
-        self.event = threading.Event()
-        self.mutex = threading.RLock()
-        self.layout = UIEngine.Canvas(self.event, self.mutex, {
-            'meta': self.on_meta
-        })
+        self.bus.subscribe(EventBus.Log, self.on_log)
+        self.bus.subscribe(EventBus.KeyMeta, self.on_meta)
+        self.bus.subscribe(EventBus.KeyNavigate, self.on_navigate)
+        self.bus.subscribe(EventBus.Submit, self.on_input_submit)
+        self.bus.subscribe(EventBus.CoreConnected, self.on_core_connect)
+        self.bus.subscribe(EventBus.CoreClosed, self.on_core_close)
+        self.bus.subscribe(EventBus.NetworkListChanged, self.on_core_networklist, coalesce=True)
+        self.bus.subscribe(EventBus.BufferListChanged, self.on_core_bufferlist, coalesce=True)
+        self.bus.subscribe(EventBus.NewBuffer, self.on_core_newbuffer, coalesce=True)
+        self.bus.subscribe(EventBus.BufferMessage, self.on_buffer_message)
+
+        if backend is None:
+            backend = UIEngine.CursesBackend()
+        self.backend = backend
+        self.layout = UIEngine.Canvas(self.bus, wakeup=self.loop.wakeup, stats=self.stats, backend=backend)
+        # Coalesced events are delivered by the next frame
+        self.bus.on_pending = self.layout.schedule
+        for name, string in IRCUI.LAYOUTS.items():
+            self.layout.add_layout(name, string)
+            # The same with the stats panel on the right, see toggle_stats()
+            self.layout.add_layout(name + '+stats', 'hor(%s, 30 stats)' % string)
+        self.show_stats = False
+        self.layout.renderFn('winlist', self.renderWinlist)
+        self.layout.renderFn('channel', self.renderChannel)
+        self.layout.renderFn('nicklist', self.renderNicklist)
+        self.layout.renderFn('splitter', self.renderSplitter)
+        self.layout.renderFn('topic', self.renderTopic)
+        self.layout.renderFn('input', self.renderInput)
+        self.layout.renderFn('stats', self.renderStats)
+
+        self.commands = Commands.Commands()
+        self.register_commands()
+        # state of the last Tab completion, so that Tab again cycles
+        self.completion = None
+        self.search = None # the /grep running, if any
+        self.search_window = None # results of the last /grep
 
-        self.thread = None
         self.networks = []
 
         # setup windows
         self.status_window = UIComponents.TextWindow('status')
         self.windows = [self.status_window]
+        # key -> window, windows are kept across repopulate_windows()
+        self.window_keys = {'status': self.status_window}
+        # sorted (name key, index), for finding windows by name
+        self.window_names = []
         self.current_window_index = 0
+        self.winlist_scroll = 0 # index of the first window in view in the window list
+        self.index_window_names()
         self.set_layout(self.windows[self.current_window_index].get_layout())
 
     def run(self):
-        self.thread = threading.Thread(target = self.layout.run)
-        self.thread.start()
+        # Runs the UI and the core connection until stop() is called
+        self.backend.run(self._run)
+
+    def _run(self, screen):
+        self.layout.start(screen)
+        self.loop.add_reader(sys.stdin.fileno(), self.layout.on_input)
+        self.loop.add_signal_handler(signal.SIGWINCH, self.layout.on_resize)
+        self.tick_stats()
+        try:
+            self.loop.run(self.layout.timeout, self.layout.update)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.search is not None:
+                self.search.stop()
+            self.layout.stop()
+            self.loop.remove_reader(sys.stdin.fileno())
+            self.loop.close()
 
     def stop(self):
-        self.layout.stop()
-        self.event.set()
+        self.loop.stop()
 
     def isRunning(self):
-        return self.thread.is_alive()
+        return self.loop.is_running()
 
     def refresh(self):
-        self.layout.refresh()
+        # Redraws are rate limited by the canvas, so this is cheap
+        self.layout.schedule()
 
     def set_layout(self, name):
-        self.layout.layout(IRCUI.LAYOUTS[name])
-        self.layout.renderFn('winlist', self.renderWinlist)
-        self.layout.renderFn('channel', self.renderChannel)
-        self.layout.renderFn('nicklist', self.renderNicklist)
-        self.layout.renderFn('splitter', self.renderSplitter)
-        self.layout.renderFn('topic', self.renderTopic)
-        self.layout.renderFn('input', self.renderInput)
+        if self.show_stats:
+            name += '+stats'
+        self.layout.set_layout(name)
+
+    def toggle_stats(self):
+        self.show_stats = not self.show_stats
+        # A new layout starts a new widget context, keep the input line
+        text = self.layout.get_text('input')
+        cursor = self.layout.get_text_cursor('input')
+        self.set_layout(self.windows[self.current_window_index].get_layout())
+        self.layout.set_text('input', text, cursor)
+        self.refresh()
 
     def renderWinlist(self, screen, widget_context, panel_id, x, y, w, h):
-        for yy in range(len(self.windows)):
-            if yy >= h:
-                break
-            screen.addstr(y+yy, x, str(yy+1))
-            if w-2 > 0:
-                self.windows[yy].render_tab(screen, widget_context, x+2, y+yy, w-2, 1, yy == self.current_window_index)
+        UIEngine.clear(screen, x, y, w, h)
+        if h <= 0:
+            return
+
+        # Only the windows in view are drawn, the view follows the current
+        # window
+        current = self.current_window_index
+        if current < self.winlist_scroll:
+            self.winlist_scroll = current
+        elif current >= self.winlist_scroll + h:
+            self.winlist_scroll = current - h + 1
+        self.winlist_scroll = max(0, min(self.winlist_scroll, len(self.windows) - h))
+
+        numw = len(str(len(self.windows))) + 1
+        for idx in range(self.winlist_scroll, min(len(self.windows), self.winlist_scroll + h)):
+            yy = y + idx - self.winlist_scroll
+            screen.addstr(yy, x, TextWidth.truncate(str(idx+1), w))
+            if w-numw > 0:
+                self.windows[idx].render_tab(screen, widget_context, x+numw, yy, w-numw, 1, idx == current)
 
     def renderChannel(self, screen, widget_context, panel_id, x, y, w, h):
         self.windows[self.current_window_index].render(screen, widget_context, x, y, w, h)
@@ -105,10 +199,8 @@ ver(
 
     def renderTopic(self, screen, widget_context, panel_id, x, y, w, h):
 
-        text = self.windows[self.current_window_index].name
-        text += ' ' * max(0, (w-len(text)))
-        text = text[:w]
-        screen.addstr(y, x, text, curses.color_pair(3) | curses.A_BOLD)
+        text = TextWidth.pad(self.windows[self.current_window_index].name, w)
+        screen.addstr(y, x, text, UIEngine.color_pair(3) | curses.A_BOLD)
 
     def renderInput(self, screen, widget_context, panel_id, x, y, w, h):
 
@@ -116,89 +208,431 @@ ver(
         screen.addstr(y, x, '> ', 0)
         widget_context.render_text_input('input', screen, x+2, y, w-2, h, 0)
 
+    def renderStats(self, screen, widget_context, panel_id, x, y, w, h):
+        UIEngine.clear(screen, x, y, w, h)
+
+        stats = self.stats
+        requests = 0
+        if self.state is not None:
+            requests = len(self.state.socket.requests)
+
+        lines = [
+            'redraws   %d/s' % stats.redraws.per_second(),
+            'frames in %d/s' % stats.frames_in.per_second(),
+            'messages  %d/s' % stats.messages.per_second(),
+            'bytes in  %s/s %s' % (format_bytes(stats.bytes_in.per_second()), format_bytes(stats.bytes_in.total)),
+            'bytes out %s/s %s' % (format_bytes(stats.bytes_out.per_second()), format_bytes(stats.bytes_out.total)),
+            'requests  %d' % requests,
+        ]
+        if self.backend.frame_bytes is not None:
+            lines.append('tty out   %s/frame' % format_bytes(self.backend.frame_bytes))
+        lines += [
+            '',
+            'panel ms    last    p99',
+        ]
+        for name, timing in sorted(stats.panels.items()):
+            lines.append('%-10s %6.2f %6.2f' % (name[:10], timing.last * 1000, timing.percentile(0.99) * 1000))
+
+        lines += [
+            '',
+            'handler ms      total    max',
+        ]
+        called = [sub for sub in self.bus.stats() if sub.calls > 0]
+        for sub in called[:IRCUI.STATS_HANDLERS]:
+            name = sub.name.rsplit('.', 1)[-1]
+            lines.append('%-15s %5.1f %6.2f' % (name[:15], sub.total_time * 1000, sub.max_time * 1000))
+
+        for yy in range(min(h, len(lines))):
+            screen.addstr(y+yy, x+1, TextWidth.truncate(lines[yy], w-1))
+
+    def tick_stats(self):
+        # Rates change without anything else happening, redraw the HUD
+        # every second
+        if self.show_stats:
+            self.layout.invalidate('stats')
+            self.refresh()
+        self.loop.call_later(1.0, self.tick_stats)
+
     def renderSplitter(self, screen, widget_context, panel_id, x, y, w, h):
-        screen.addstr(y, x, ' '*w, curses.A_REVERSE)
+        UIEngine.fill(screen, x, y, w, h, ' ', curses.A_REVERSE)
+
+    def log_exception(self, msg):
+        self.pushStatusMessage('Exception in main loop: ' + msg)
 
     def pushStatusMessage(self, msg):
-        with self.mutex:
-            self.status_window.push_message(msg)
+        self.status_window.push_message(msg)
+        if self.windows[self.current_window_index] is self.status_window:
+            self.layout.invalidate('channel')
+        self.layout.invalidate('winlist')
         self.refresh()
 
     def pushMessage(self, msg):
-        with self.mutex:
-            self.windows[self.current_window_index].push_message(msg)
+        self.windows[self.current_window_index].push_message(msg)
+        self.layout.invalidate('channel')
+        self.layout.invalidate('winlist')
         self.refresh()
 
-    def on_meta(self, char):
-        # Alt+number switches windows:
+    def invalidate_windows(self):
+        # The window list changed
+        self.layout.invalidate('winlist')
+        self.layout.invalidate('channel')
+        self.layout.invalidate('topic')
+
+    def on_log(self, event):
+        self.pushStatusMessage(event.msg)
+
+    def on_meta(self, event):
+        # Alt+number switches windows, Alt+n and Alt+p go to the next and
+        # previous one, Alt+s shows or hides the stats panel:
+
+        char = event.char
+
+        if char == ord('s'):
+            self.toggle_stats()
+            return
+
+        if char == ord('n') or char == ord('p'):
+            step = 1 if char == ord('n') else -1
+            self.switch_window((self.current_window_index + step) % len(self.windows))
+            self.refresh()
+            return
 
         if char >= ord('0') and char <= ord('9'):
             idx = char-ord('0')-1
             if idx < 0: idx += 10
             if idx < len(self.windows):
-                self.current_window_index = idx
-                self.set_layout(self.windows[idx].get_layout())
+                self.switch_window(idx)
                 self.refresh()
             return
         self.pushStatusMessage('unhandled meta key: ' + chr(char))
 
+    def on_navigate(self, event):
+        if event.key == 9:
+            self.complete_input()
+
+        # PageUp/PageDown scroll the current window
+        elif event.key == curses.KEY_PPAGE or event.key == curses.KEY_NPAGE:
+            window = self.windows[self.current_window_index]
+            if isinstance(window, UIComponents.TextWindow):
+                window.scroll_page(1 if event.key == curses.KEY_PPAGE else -1)
+                self.layout.invalidate('channel')
+                self.refresh()
+
+    def complete_input(self):
+        # Tab completes the word before the cursor, pressing it again goes
+        # to the next candidate
+
+        text = self.layout.get_text('input')
+        cursor = self.layout.get_text_cursor('input')
+
+        c = self.completion
+        if c is not None and c['text'] == text and c['cursor'] == cursor:
+            c['index'] = (c['index'] + 1) % len(c['candidates'])
+        else:
+            start = cursor
+            while start > 0 and not text[start-1].isspace():
+                start -= 1
+            candidates = self.completions(text[start:cursor], start == 0)
+            if len(candidates) == 0:
+                self.completion = None
+                return
+            c = {'before': text[:start], 'after': text[cursor:], 'candidates': candidates, 'index': 0}
+            self.completion = c
+
+        word, suffix = c['candidates'][c['index']]
+        if len(c['after']) > 0:
+            suffix = ''
+        before = c['before'] + word + suffix
+        c['text'] = before + c['after']
+        c['cursor'] = len(before)
+        self.layout.set_text('input', c['text'], c['cursor'])
+
+    def completions(self, word, first):
+        # (completion, suffix) pairs for word, the best ones first. Nicks of
+        # the current buffer come by most recent speaker, then buffer names.
+
+        if first and word.startswith('/'):
+            return [('/' + name, ' ') for name in self.commands.complete(word[1:])]
+
+        found = []
+        window = self.windows[self.current_window_index]
+        if isinstance(window, UIComponents.BufferWindow) and (len(word) == 0 or word[0] not in '#&!+'):
+            for nick in window.buffer.nicks.complete(word, IRCUI.COMPLETIONS):
+                found.append((nick, ': ' if first else ' '))
+        nicks = set(nick for nick, _ in found)
+        for name in self.buffer_names(word, IRCUI.COMPLETIONS - len(found)):
+            if name not in nicks:
+                found.append((name, ' '))
+        return found
+
+    def buffer_names(self, prefix, limit):
+        # Names of buffer windows starting with prefix, sorted
+        key = self.window_name_key(prefix)
+        names = []
+        i = bisect.bisect_left(self.window_names, (key,))
+        while i < len(self.window_names) and len(names) < limit and self.window_names[i][0].startswith(key):
+            window = self.windows[self.window_names[i][1]]
+            if isinstance(window, UIComponents.BufferWindow) and window.name not in names:
+                names.append(window.name)
+            i += 1
+        return names
+
+    def switch_window(self, idx):
+        if idx != self.current_window_index and self.current_window_index < len(self.windows):
+            self.windows[self.current_window_index].on_hide()
+        self.current_window_index = idx
+        self.set_layout(self.windows[idx].get_layout())
+
+    @staticmethod
+    def window_name_key(name):
+        # Names are matched case-insensitively and without channel prefixes
+        return name.lower().lstrip('#&!+')
+
+    def index_window_names(self):
+        self.window_names = sorted((self.window_name_key(window.name), idx) for idx, window in enumerate(self.windows))
+
+    def find_window(self, query):
+        # Index of the window matching query best, or None. Names starting
+        # with the query are found with a bisect, names only containing it
+        # are looked for if there's none.
+
+        key = self.window_name_key(query)
+        i = bisect.bisect_left(self.window_names, (key,))
+        if i < len(self.window_names) and self.window_names[i][0].startswith(key):
+            return self.window_names[i][1]
+
+        for name, idx in self.window_names:
+            if key in name:
+                return idx
+        return None
+
+    def window_for(self, key, create):
+        window = self.window_keys.get(key)
+        if window is None:
+            window = create()
+        return window
+
     def repopulate_windows(self):
 
+        current = None
+        if self.current_window_index < len(self.windows):
+            current = self.windows[self.current_window_index]
+
+        # Windows are looked up by key, so existing ones keep their contents
+        keys = {'status': self.status_window}
         self.windows = [self.status_window]
 
         for network in self.networks:
 
-            bufs = network.buffer_list()
-
-            self.windows.append(UIComponents.NetworkWindow(network))
+            key = ('network', network.id)
+            window = self.window_for(key, lambda: UIComponents.NetworkWindow(network))
+            window.set_network(network)
+            keys[key] = window
+            self.windows.append(window)
 
             for buffer in network.buffer_list():
-                self.windows.append(UIComponents.BufferWindow(network, buffer))
+                key = ('buffer', network.id, buffer.id)
+                window = self.window_for(key, lambda: UIComponents.BufferWindow(network, buffer))
+                window.set_buffer(network, buffer)
+                keys[key] = window
+                self.windows.append(window)
+
+        if self.search_window is not None:
+            keys[('search',)] = self.search_window
+            self.windows.append(self.search_window)
+
+        self.window_keys = keys
+        self.index_window_names()
+
+        # Stay on the current window if it's still there
+        if current in keys.values():
+            self.current_window_index = self.windows.index(current)
+        else:
+            self.current_window_index = min(self.current_window_index, len(self.windows)-1)
+            self.set_layout(self.windows[self.current_window_index].get_layout())
+
+    def on_input_submit(self, event):
+        if event.widget.startswith('config_'):
+            self.submit_network_configuration()
+            return
+        if event.widget != 'input':
+            return
+        self.layout.set_text('input', '')
+        self.on_submit(event.text)
+
+    def submit_network_configuration(self):
+        # Enter in either field of a network window saves both of them
+        network = self.windows[self.current_window_index].network
+        if network is None or self.state is None:
+            return
+        server = self.layout.get_text('config_server')
+        nickname = self.layout.get_text('config_nickname')
+        self.pushStatusMessage('Saving configuration of network ' + str(network.id))
+        self.state.set_network_configuration(network, server, nickname)
+
+    def register_commands(self):
+        self.commands.register('connect', ('address',), self.command_connect,
+            'Connect the current network to an IRC server')
+        self.commands.register('window', ('name...',), self.command_window,
+            'Switch to a window by name or number', aliases=('win',))
+        self.commands.register('grep', ('[regex...]',), self.command_grep,
+            'Search the current window, /grep alone stops the search')
+        self.commands.register('stats', (), self.toggle_stats,
+            'Show or hide the stats panel')
+        self.commands.register('help', ('[command]',), self.command_help,
+            'List the commands or show how to use one')
+        self.commands.register('quit', (), self.command_quit,
+            'Quit')
 
     def on_submit(self, line):
 
         line = line.strip()
 
-        if re.match('^/', line):
+        if line.startswith('/'):
+            try:
+                self.commands.run(line[1:])
+            except Commands.CommandError as e:
+                self.pushStatusMessage(str(e))
+
+    def current_network(self):
+        # Network of the current window, the first one otherwise
+        window = self.windows[self.current_window_index]
+        network = window.network
+        if network is None and len(self.networks) > 0:
+            network = self.networks[0]
+        return network
+
+    def command_connect(self, address):
+        network = self.current_network() if self.state is not None else None
+        if network is None:
+            self.pushStatusMessage('Not connected to a core with networks')
+            return
+        self.pushStatusMessage('Connecting to: ' + address)
+        self.state.core_connect(network, address)
+
+    def command_window(self, query):
+        if query.isdecimal():
+            idx = int(query)-1
+            if idx < 0 or idx >= len(self.windows):
+                idx = None
+        else:
+            idx = self.find_window(query)
+        if idx is None:
+            self.pushStatusMessage('No window matches: ' + query)
+            return
+        self.switch_window(idx)
+        self.refresh()
 
-            cmd = re.split(' +', line[1:])
+    def command_grep(self, pattern):
+        if pattern is None:
+            # It says it stopped once the thread notices
+            if self.search is not None:
+                self.search.cancel()
+            return
+
+        window = self.windows[self.current_window_index]
+        if not isinstance(window, UIComponents.TextWindow):
+            self.pushStatusMessage('Nothing to search in this window')
+            return
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            self.pushStatusMessage('Invalid regex: ' + str(e))
+            return
+
+        if self.search is not None:
+            self.search.cancel()
+        self.search = Search.Search(regex, window.lines.snapshot(), self.loop.call_soon_threadsafe,
+            self.on_search_results, self.on_search_done)
+
+        # Results go to a new window, the old one is dropped
+        if self.search_window is not None:
+            self.search_window.lines.close()
+        self.search_window = UIComponents.TextWindow('grep: ' + pattern)
+        self.search_window.push_message('Searching ' + window.name + ' for ' + pattern)
+        self.repopulate_windows()
+        self.switch_window(len(self.windows)-1)
+        self.invalidate_windows()
+        self.refresh()
 
-            if cmd[0] == 'connect' and len(cmd) > 1:
-                self.pushStatusMessage('Connecting to: ' + cmd[1])
-                self.state.core_connect(self.networks[0], cmd[1])
+        self.search.start()
 
-    def on_core_connect(self):
+    def push_search_results(self, msg):
+        self.search_window.push_message(msg)
+        if self.windows[self.current_window_index] is self.search_window:
+            self.layout.invalidate('channel')
+        self.refresh()
+
+    def on_search_results(self, search, texts):
+        # Batches of a search that was replaced are dropped
+        if search is self.search:
+            self.push_search_results('\n'.join(texts))
+
+    def on_search_done(self, search, matches, lines, cancelled):
+        if search is not self.search:
+            return
+        self.search = None
+        if cancelled:
+            self.push_search_results('Search stopped after %d lines, %d matches' % (lines, matches))
+        else:
+            self.push_search_results('Searched %d lines, %d matches' % (lines, matches))
+
+    def command_help(self, name):
+        if name is not None:
+            command = self.commands.lookup(name.lstrip('/'))
+            self.pushStatusMessage(command.usage() + ': ' + command.help)
+            return
+        for command in self.commands.commands():
+            self.pushStatusMessage('%-24s %s' % (command.usage(), command.help))
+
+    def command_quit(self):
+        self.stop()
+
+    def on_core_connect(self, event):
         self.pushStatusMessage('Connected to core')
 
-    def on_core_close(self):
+    def on_core_close(self, event):
         self.pushStatusMessage('Disconnected from core')
+        self.state.close()
         self.state = None
         self.networks = []
         self.repopulate_windows()
+        self.invalidate_windows()
+        self.refresh()
 
-    def on_core_networklist(self, networks):
-        self.networks = networks
-        self.repopulate_windows()
+    def on_buffer_message(self, event):
+        key = ('buffer', event.network.id, event.buffer.id)
+        if key not in self.window_keys:
+            # The coalesced buffer list update hasn't been delivered yet
+            self.repopulate_windows()
+            self.invalidate_windows()
+        window = self.window_keys.get(key)
+        if window is None:
+            return
+
+        window.push_message(event.text)
+        if self.windows[self.current_window_index] is window:
+            self.layout.invalidate('channel')
+        self.layout.invalidate('winlist')
         self.refresh()
 
-    def on_core_bufferlist(self, network):
+    # The following are coalesced, so they run at most once per frame from
+    # inside Canvas.refresh and don't need to refresh themselves
+
+    def on_core_networklist(self, event):
+        self.networks = event.networks
         self.repopulate_windows()
-        self.refresh()
+        self.invalidate_windows()
 
-    def on_core_newbuffer(self):
+    def on_core_bufferlist(self, event):
         self.repopulate_windows()
-        self.refresh()
+        self.invalidate_windows()
+
+    def on_core_newbuffer(self, event):
+        self.repopulate_windows()
+        self.invalidate_windows()
 
     def connect(self, hostport):
 
-        self.state = IRCState(
-            hostport,
-            callbacks = {
-                'logger': self.pushStatusMessage,
-                'core_connect': self.on_core_connect,
-                'core_close': self.on_core_close,
-                'core_networklist': self.on_core_networklist,
-                'core_bufferlist': self.on_core_bufferlist,
-                'core_newbuffer': self.on_core_newbuffer,
-        })
+        self.state = IRCState(hostport, self.bus, self.stats)
 
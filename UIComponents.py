@@ -1,131 +1,338 @@
 import curses
 import UIEngine
-import math
 import re
+import Formatting
 import IRCState
+import TextWidth
+import Scrollback
 
 class Window:
     def __init__(self, name):
         self.name = name
+        self.network = None # network the window belongs to, if any
 
     def get_layout(self):
         return 'status'
 
+    def on_hide(self):
+        pass
+
     def render(self, screen, widget_context, x, y, w, h):
         UIEngine.nullRender(screen, self.name, x, y, w, h)
 
     def render_tab(self, screen, widget_context, x, y, w, h, selected):
 
         if selected:
-            attr = curses.color_pair(1) | curses.A_UNDERLINE
+            attr = UIEngine.color_pair(1) | curses.A_UNDERLINE
         else:
-            attr = curses.color_pair(2)
+            attr = UIEngine.color_pair(2)
 
-        screen.addstr(y, x, self.name[:w], attr)
+        screen.addstr(y, x, TextWidth.truncate(self.name, w), attr)
 
 class TextWindow(Window):
-    def __init__(self, name):
+
+    # The pad keeps this many screenfuls of rendered rows around the viewport
+    PAD_PAGES = 4
+    # Default amount of lines kept in memory, older ones are spilled to disk
+    MAX_LINES = 2000
+
+    def __init__(self, name, max_lines=None):
         Window.__init__(self, name)
-        self.lines = []
+        if max_lines is None:
+            max_lines = TextWindow.MAX_LINES
+        self.lines = Scrollback.Scrollback(max_lines, Formatting.line)
+        self.scroll = 0 # rows scrolled up from the bottom
+        self.height = 0 # height of the last render, used for paging
+
+        # Wrap index of the lines in view for the width of the last render.
+        # It is rebuilt when the width changes or lines are paged in, and
+        # appended to otherwise.
+        self._index = None
+
+        # pad holding the wrapped rows self._pad_top...self._pad_top+self._pad_rows-1
+        self._pad = None
+        self._pad_width = 0
+        self._pad_top = 0
+        self._pad_rows = 0
+        self._pad_capacity = 0
 
     def push_message(self, msg):
-        self.lines += re.split('\n', msg)
+        # Formatting is parsed once here, drawing only replays the spans
+        new_lines = [Formatting.line(line) for line in re.split('\n', msg)]
+
+        if self._index is None:
+            for line in new_lines:
+                self.lines.append(line)
+            return
+
+        self._keep_viewport(self.height)
+        old_total = self._index.total()
+        dropped = 0 # rows that fell out of memory at the top
+        cut = 0 # rows that left the view at the bottom, below the viewport
+        for line in new_lines:
+            if not self.lines.following():
+                self.lines.append(line)
+                continue
+            n = len(self.lines)
+            gone = self.lines.append(line)
+            dropped += self._index.drop(gone)
+            if self.lines.following():
+                self._index.append(line)
+            else:
+                # Too many lines were paged in, the view ends with them now
+                cut += self._index.truncate(n - gone - len(self.lines))
+        bottom = old_total - dropped - cut
+        added = self._index.total() - bottom
+
+        # Keep the viewport still when scrolled up
+        if self.scroll > 0:
+            self.scroll = max(0, self.scroll + added - cut)
+
+        # Row numbers shift by the rows dropped at the top
+        self._pad_top -= dropped
+        if self._pad_top < 0 or cut > 0:
+            self._pad = None
+
+        # If the pad reaches the bottom and there's room left, appending is
+        # just drawing the new rows at the end of it
+        if self._pad is None or self._pad_top + self._pad_rows != bottom:
+            return
+        if self._pad_rows + added > self._pad_capacity:
+            return
+        for line, row in self._index.rows(self.lines, bottom, added):
+            self._draw_row(line, row)
+
+    def on_hide(self):
+        # Pads are big, only keep one for the window being shown
+        self._pad = None
+
+    def scroll_page(self, pages):
+        self.scroll = max(0, self.scroll + pages * max(1, self.height - 1))
+
+    def _keep_viewport(self, h):
+        # Tell the scrollback which lines are on screen, with a screenful
+        # around them, so that it doesn't drop them to stay within its limits
+        total = self._index.total()
+        top = total - h - self.scroll
+        first = self.lines.first() + self._index.skipped # first measured line
+
+        start = self.lines.first()
+        if top - h > 0:
+            start = first + self._index.find(top - h)
+
+        stop = self.lines.first() + len(self.lines)
+        if top + 2 * h <= 0:
+            stop = first
+        elif top + 2 * h < total:
+            stop = first + self._index.find(top + 2 * h) + 1
+
+        self.lines.keep(start, stop)
+
+    def _fill_pad(self, top, w, h):
+        # Draw the rows around the viewport starting at row top into the pad,
+        # leaving room below for new messages
+
+        capacity = h * self.PAD_PAGES
+        if self._pad is None or self._pad_capacity != capacity or self._pad_width != w:
+            # one extra column so that full-width rows don't hit the last cell
+            self._pad = UIEngine.newpad(max(1, capacity), w + 1)
+            self._pad_capacity = capacity
+            self._pad_width = w
+        else:
+            self._pad.erase()
+
+        self._pad_top = max(0, top - h)
+        self._pad_rows = 0
+        count = min(capacity, self._index.total() - self._pad_top)
+        for line, row in self._index.rows(self.lines, self._pad_top, count):
+            self._draw_row(line, row)
+
+    def _draw_row(self, line, row):
+        # Add a row of line at the end of the pad
+        w = self._index.width
+        if line.spans is None:
+            self._pad.addstr(self._pad_rows, 0, line.row(w, row))
+        else:
+            x = 0
+            for text, attr in Formatting.segments(line, w, row):
+                self._pad.addstr(self._pad_rows, x, text, attr)
+                x += TextWidth.width(text)
+        self._pad_rows += 1
 
     def render(self, screen, widget_context, x, y, w, h):
-        # Clear..
-        for yy in range(y,y+h):
-            screen.addstr(yy,x,' '*w)
-
-        # Whether to draw an extra symbol to help distinguish long messages from each other:
-        drawBullet = False
-
-        if drawBullet:
-            x += 2
-            w -= 2
-            if w <= 0:
-                return
-        # Let's do some wrapping..
-        pos = y+h-1
-        for i in range(len(self.lines)):
-            idx = len(self.lines)-i-1
-
-            thisline = self.lines[idx]
-
-            linecount = int(math.ceil(float(len(thisline))/w))
-
-            if pos-linecount < y:
-                break
-
-            if drawBullet:
-                screen.addch(y+pos-linecount,x-2, curses.ACS_DIAMOND)
-            for a in range(linecount):
-                screen.addstr(y+pos-linecount+a, x, thisline[:w].encode('utf-8'))
-                thisline = thisline[w:]
-            pos -= linecount
-
+        UIEngine.clear(screen, x, y, w, h)
+        self.height = h
+
+        # Rows the index has to cover: the viewport and the pad page above
+        # it. A new width is wrapped from the bottom up to there, the lines
+        # further up are measured once scrolled to.
+        need = 2 * h + self.scroll
+
+        if self._index is None or self._index.width != w:
+            self._index = UIEngine.WrapIndex(w, self.lines, need)
+            self._pad = None
+
+        if self.scroll == 0 and self.lines.has_pages() and self.lines.following():
+            # Back at the bottom, drop the lines paged in from disk
+            self.lines.release_pages()
+            self._index = UIEngine.WrapIndex(w, self.lines, need)
+            self._pad = None
+        else:
+            # The pad rows move down by the rows measured above them
+            self._pad_top += self._index.grow(self.lines, need)
+
+            if self.scroll > 0 and self._index.total() - h - self.scroll < 0 and self.lines.can_page_in():
+                # Scrolled past the first line in memory, page in older ones
+                while self._index.total() - h - self.scroll < 0:
+                    self._keep_viewport(h)
+                    old_len = len(self.lines)
+                    n = self.lines.page_in()
+                    if n == 0:
+                        break
+                    self._index.add_above(n)
+                    # Lines past Scrollback.max_paged are dropped below the
+                    # viewport
+                    self.scroll -= self._index.truncate(old_len + n - len(self.lines))
+                    self._index.grow(self.lines, need)
+                self._pad = None
+
+            if self.scroll < h and not self.lines.following():
+                # Near the end of the lines paged in, read the ones after them
+                while self.scroll < h and not self.lines.following():
+                    self._keep_viewport(h)
+                    old_len = len(self.lines)
+                    dropped = self.lines.page_down()
+                    self._index.drop(dropped)
+                    old_total = self._index.total()
+                    for i in range(old_len - dropped, len(self.lines)):
+                        self._index.append(self.lines[i])
+                    self.scroll += self._index.total() - old_total
+                self._pad = None
+
+        total = self._index.total()
+        self.scroll = max(0, min(self.scroll, total - h))
+        top = max(0, total - h - self.scroll)
+        rows = min(h, total - top)
+        self._keep_viewport(h)
+
+        if self._pad is None or top < self._pad_top or top + rows > self._pad_top + self._pad_rows:
+            self._fill_pad(top, w, h)
+
+        # Flush the cleared panel first, then show the viewport of the pad
+        # at the bottom of it. Only touched lines are copied by noutrefresh,
+        # and the viewport may have moved since the rows were drawn.
+        screen.touchwin()
+        screen.noutrefresh()
+        if rows <= 0:
+            return
+        by, bx = screen.getbegyx()
+        self._pad.touchline(top - self._pad_top, rows)
+        self._pad.noutrefresh(top - self._pad_top, 0, by + y + h - rows, bx + x, by + y + h - 1, bx + x + w - 1)
+
+
+# Widgets are laid out with measure(), which returns the size they take and
+# lets containers remember where their items go, and drawn with paint().
+# A tree only has to be measured again when the space it's given changes.
 
 class Text:
     def __init__(self, text):
         self.text = text
+        self.width = TextWidth.width(text)
 
-    def render(self, screen, widget_context, x, y, w, h):
-        screen.addstr(y, x, self.text[:w], 0)
-        return len(self.text), 1
+    def measure(self, w, h):
+        return self.width, 1
+
+    def paint(self, screen, widget_context, x, y, w, h):
+        if w <= 0 or h <= 0:
+            return
+        screen.addstr(y, x, TextWidth.truncate(self.text, w), 0)
 
 class TextInput:
     def __init__(self, name, focus):
         self.name = name
         self.focus = focus
 
-    def render(self, screen, widget_context, x, y, w, h):
+    def measure(self, w, h):
+        # The text changes without the tree being measured again, so the
+        # input takes the rest of the row
+        return w, 1
+
+    def paint(self, screen, widget_context, x, y, w, h):
+        if w <= 0 or h <= 0:
+            return
         widget_context.render_text_input(self.name, screen, x, y, w, h, self.focus)
-        return len(widget_context.get_text(self.name)), 1
 
 class Spacing:
     def __init__(self, count):
         self.count = count
 
-    def render(self, screen, widget_context, x, y, w, h):
+    def measure(self, w, h):
         return self.count, self.count
 
+    def paint(self, screen, widget_context, x, y, w, h):
+        pass
+
 class Horizontal:
     def __init__(self, items):
         self.items = items
+        self._rects = [] # (x, y, w, h) of each item relative to this one
 
-    def render(self, screen, widget_context, x, y, w, h):
-        step = [0, 0]
+    def measure(self, w, h):
+        self._rects = []
+        step = 0
         minh = 0
         for item in self.items:
-            size = item.render(screen, widget_context, x+step[0], y+step[1], w-step[0], h-step[1])
-            step[0] += min(size[0], w-step[0])
+            size = item.measure(w-step, h)
+            self._rects.append((step, 0, w-step, h))
+            step += min(size[0], w-step)
             minh = max(minh, size[1])
         return w, minh
 
+    def paint(self, screen, widget_context, x, y, w, h):
+        for item, (dx, dy, iw, ih) in zip(self.items, self._rects):
+            item.paint(screen, widget_context, x+dx, y+dy, iw, ih)
+
 class Vertical:
     def __init__(self, items):
         self.items = items
+        self._rects = []
 
-    def render(self, screen, widget_context, x, y, w, h):
-        step = [0, 0]
+    def measure(self, w, h):
+        self._rects = []
+        step = 0
         minw = 0
         for item in self.items:
-            size = item.render(screen, widget_context, x+step[0], y+step[1], w-step[0], h-step[1])
-            step[1] += min(size[1], h-step[1])
+            size = item.measure(w, h-step)
+            self._rects.append((0, step, w, h-step))
+            step += min(size[1], h-step)
             minw = max(minw, size[0])
         return minw, h
 
+    def paint(self, screen, widget_context, x, y, w, h):
+        for item, (dx, dy, iw, ih) in zip(self.items, self._rects):
+            item.paint(screen, widget_context, x+dx, y+dy, iw, ih)
+
 class NetworkWindow(Window):
 
     def __init__(self, network):
-        Window.__init__(self, 'Network: ' + str(network.state))
+        Window.__init__(self, '')
+        self.set_network(network)
+
+        # Widget tree and what it was built and measured for
+        self._tree = None
+        self._tree_key = None # (network, network version, widget context)
+        self._tree_size = None
+
+    def set_network(self, network):
+        # Windows are kept when the window list is rebuilt, refresh what
+        # they show
         self.network = network
+        self.name = 'Network: ' + str(network.state)
 
     def get_layout(self):
         return 'network'
 
-    def render(self, screen, widget_context, x, y, w, h):
-
-        UIEngine.clear(screen, x, y, w, h)
+    def _build(self, widget_context):
 
         items = []
 
@@ -158,10 +365,36 @@ class NetworkWindow(Window):
 
         items.append(Spacing(1))
 
-        Vertical(items).render(screen, widget_context, x, y, w, h)
+        return Vertical(items)
+
+    def render(self, screen, widget_context, x, y, w, h):
+
+        UIEngine.clear(screen, x, y, w, h)
+
+        # The tree is only built again when the network changes, and a new
+        # widget context (after a layout switch) needs the default values
+        key = (self.network, self.network.version, widget_context)
+        if self._tree is None or self._tree_key != key:
+            self._tree = self._build(widget_context)
+            self._tree_key = key
+            self._tree_size = None
+
+        if self._tree_size != (w, h):
+            self._tree.measure(w, h)
+            self._tree_size = (w, h)
+
+        self._tree.paint(screen, widget_context, x, y, w, h)
 
-class BufferWindow(Window):
+class BufferWindow(TextWindow):
 
     def __init__(self, network, buffer):
-        Window.__init__(self, 'Buffer')
+        TextWindow.__init__(self, buffer.name)
+        self.set_buffer(network, buffer)
+
+    def set_buffer(self, network, buffer):
+        # Windows are kept when the window list is rebuilt, refresh what
+        # they show
+        self.network = network
+        self.buffer = buffer
+        self.name = buffer.name
 
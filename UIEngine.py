@@ -2,7 +2,16 @@
 # -*- coding: utf-8 -*- 
 
 import curses 
+import codecs
 import re
+import bisect
+import time
+import os
+import sys
+import TextWidth
+import EventBus
+import GapBuffer
+import Stats
 
 def splitparts(string, parts):
     if len(parts) == 0:
@@ -16,68 +25,148 @@ def splitparts(string, parts):
     ret.append(string[parts[-1]+1:])
     return ret
 
+def _covers(screen, x, y, w, h):
+    # Whether the area is the whole window
+    return x == 0 and y == 0 and screen.getmaxyx() == (h, w)
+
+def fill(screen, x, y, w, h, ch=' ', attr=0):
+    # One call per row, or for the whole window at once. Unlike addstr,
+    # hline doesn't move the cursor, so the bottom-right cell can be filled.
+    if w <= 0 or h <= 0:
+        return
+    if ch == ' ' and attr == 0 and _covers(screen, x, y, w, h):
+        screen.erase()
+        return
+    c = ord(ch) | attr
+    for yy in range(y, y+h):
+        screen.hline(yy, x, c, w)
+
+def box(screen, x, y, w, h, attr=0):
+    if w < 2 or h < 2:
+        fill(screen, x, y, w, h, '+', attr)
+        return
+    hor = ord('-') | attr
+    ver = ord('|') | attr
+    corner = ord('+') | attr
+    if _covers(screen, x, y, w, h):
+        screen.border(ver, ver, hor, hor, corner, corner, corner, corner)
+        return
+    screen.hline(y, x+1, hor, w-2)
+    screen.hline(y+h-1, x+1, hor, w-2)
+    screen.vline(y+1, x, ver, h-2)
+    screen.vline(y+1, x+w-1, ver, h-2)
+    for cy, cx in ((y, x), (y, x+w-1), (y+h-1, x), (y+h-1, x+w-1)):
+        screen.hline(cy, cx, corner, 1)
+
 def nullRender(screen, panel_id, x, y, w, h):
+    if w <= 0 or h <= 0:
+        return
     attr = curses.A_DIM
-    for yy in range(1, h-1):
-        for xx in range(1, w-1):
-            screen.addch(y+yy,x+xx,' ', attr)
-    msg = panel_id
-    for i in range(len(msg)):
-        pos = x+w/2+i - len(msg)/2
-        if pos >= x+w:
-            break
-        if pos <= x:
-            continue
-        screen.addch(int(y+h/2), int(pos), msg[i], attr)
-
-    screen.addch(y,x,'+', attr)
-    screen.addch(y,x+w-1,'+', attr)
-    screen.addch(y+h-1,x,'+', attr)
-    try:
-        screen.addch(y+h-1,x+w-1,'+', attr)
-    except curses.error: pass
-    for i in range(1,w-1):
-        screen.addch(y,x+i, '-', attr)
-        screen.addch(y+h-1,x+i, '-', attr)
-    for i in range(1,h-1):
-        screen.addch(y+i,x, '|', attr)
-        screen.addch(y+i,x+w-1, '|', attr)
+    fill(screen, x, y, w, h, ' ', attr)
+    box(screen, x, y, w, h, attr)
+
+    # panel_id centered, inside the box
+    msg = str(panel_id)
+    pos = x + w//2 - len(msg)//2
+    if pos <= x:
+        msg = msg[x+1-pos:]
+        pos = x+1
+    msg = TextWidth.truncate(msg, x+w-1-pos)
+    if len(msg) > 0:
+        screen.addstr(y+h//2, pos, msg, attr)
+
+def placeholderRender(screen, widget_context, panel_id, x, y, w, h):
+    # Render function of panels nothing was registered for
+    nullRender(screen, panel_id, x, y, w, h)
 
 def clear(screen, x, y, w, h):
-    for yy in range(0, h):
-        screen.addstr(y+yy,x,' '*w, 0)
+    fill(screen, x, y, w, h)
 
 class Panel:
     def __init__(self):
         self._children = []
         self._layout = ''
-        self._renderFn = nullRender
+        self._renderFn = placeholderRender
         self._id = None
+        self._dirty = True
+        self._x = self._y = self._w = self._h = 0
+        self._window = None # leaf sub-window, matching self._windowRect
+        self._windowRect = None
+        self.render_time = None # seconds the last render took, None if it wasn't redrawn
 
     def setDimensions(self, x, y, w, h):
+        if (x, y, w, h) != (self._x, self._y, self._w, self._h):
+            self._dirty = True
         self._x = x
         self._y = y
         self._w = w
         self._h = h
 
+    def releaseWindow(self):
+        # Drop the sub-window if it doesn't match the geometry anymore.
+        # Freeing a sub-window touches all of its parent in curses, which
+        # would paint the parent over pads drawn later in the same frame.
+        if self._windowRect != (self._x, self._y, self._w, self._h):
+            self._window = None
+            self._windowRect = None
+
+    def invalidate(self, panel_id=None):
+        # Mark leaves as needing a redraw, all of them if panel_id is None
+        if len(self._children) > 0:
+            for child in self._children:
+                child.invalidate(panel_id)
+        elif panel_id is None or self._id == panel_id:
+            self._dirty = True
+
     def renderFn(self, panel_id, func):
         if len(self._children) > 0:
             for child in self._children:
                 child.renderFn(panel_id, func)
         elif self._id == panel_id:
             self._renderFn = func
+            self._dirty = True
 
-    def render(self, screen, widget_context):
-        # Update child status
+    def leaves(self):
+        if len(self._children) == 0:
+            return [self]
+        return [leaf for child in self._children for leaf in child.leaves()]
+
+    def layoutTree(self):
+        # Compute the geometry of the whole tree from the root's dimensions
         self._doLayout()
+        for child in self._children:
+            child.layoutTree()
+
+    def render(self, screen, widget_context):
+        # Geometry is updated separately by layoutTree()
         if len(self._children) == 0:
+            # Only dirty leaves are redrawn, the rest keep their old contents
+            self.render_time = None
+            if not self._dirty:
+                return
+            start = time.perf_counter()
+            self._dirty = False
             if self._w <= 0 or self._h <= 0:
                 return
+            rect = (self._x, self._y, self._w, self._h)
+            if self._window is None or self._windowRect != rect:
+                # Render functions draw into a sub-window of their own,
+                # using coordinates relative to the panel
+                try:
+                    self._window = screen.derwin(self._h, self._w, self._y, self._x)
+                except curses.error:
+                    self._window = None
+                    return
+                self._windowRect = rect
+            widget_context.panel = self._id
             try:
-                self._renderFn(screen, widget_context, self._id, self._x, self._y, self._w, self._h)
+                self._renderFn(self._window, widget_context, self._id, 0, 0, self._w, self._h)
             except curses.error: pass
             except UnicodeEncodeError: pass
             except UnicodeDecodeError: pass
+            widget_context.panel = None
+            self._window.noutrefresh()
+            self.render_time = time.perf_counter() - start
         else:
             # Recursively redraw.
             for child in self._children:
@@ -189,6 +278,7 @@ class Panel:
 
         for i in range(len(childParams)):
             c = self._children[i]
+            old = (c._x, c._y, c._w, c._h)
             if horstack:
                 c._y = self._y
                 c._h = self._h
@@ -205,6 +295,141 @@ class Panel:
                 position += c._h
                 if position > self._y+maxwidth:
                     c._h = maxwidth - c._y
+            if (c._x, c._y, c._w, c._h) != old:
+                c.invalidate()
+
+
+class WrapIndex:
+    # Prefix sums of the amount of rows TextWidth.Lines take when wrapped to
+    # a given width: ends[i] is the row right after line i. Finding the line
+    # shown on any row is a bisect, so drawing a viewport doesn't depend on
+    # the amount of lines above it.
+    #
+    # Lines can also be dropped from the front. The first self._first
+    # entries of self._ends are then unused and rows are counted from
+    # self._base.
+    #
+    # Only the lines at the bottom may be measured: the first self.skipped
+    # lines aren't in the index until grow() gets to them. Viewports are
+    # counted from the bottom, so a new width only costs the rows shown.
+
+    def __init__(self, width, lines=(), rows=None):
+        # With rows given, lines are measured from the bottom up until they
+        # take that many rows
+        self.width = width
+        self._ends = []
+        self._first = 0
+        self._base = 0
+        self.skipped = len(lines)
+        self.grow(lines, rows)
+
+    def line_rows(self, line):
+        return line.rows(self.width)
+
+    def __len__(self):
+        return len(self._ends) - self._first
+
+    def append(self, line):
+        last = self._ends[-1] if len(self._ends) > 0 else self._base
+        self._ends.append(last + self.line_rows(line))
+
+    def add_above(self, n):
+        # n lines were added in front of the first one
+        self.skipped += n
+
+    def grow(self, lines, rows=None):
+        # Measure skipped lines until the index has at least rows rows, or
+        # all of them. Returns the amount of rows added at the top, the rows
+        # below move down by that much.
+
+        old_total = self.total()
+        if self.skipped == 0 or (rows is not None and old_total >= rows):
+            return 0
+        if rows is not None:
+            # At least double, so scrolling up a row at a time doesn't
+            # rebuild the index every time
+            rows = max(rows, 2 * old_total)
+
+        counts = []
+        total = old_total
+        i = self.skipped
+        while i > 0 and (rows is None or total < rows):
+            i -= 1
+            n = self.line_rows(lines[i])
+            counts.append(n)
+            total += n
+        added = total - old_total
+
+        ends = []
+        end = 0
+        for n in reversed(counts):
+            end += n
+            ends.append(end)
+        for e in self._ends[self._first:]:
+            ends.append(e - self._base + added)
+        self._ends = ends
+        self._first = 0
+        self._base = 0
+        self.skipped = i
+        return added
+
+    def drop(self, n):
+        # Forget the first n lines, returns the amount of rows they took
+        skip = min(n, self.skipped)
+        self.skipped -= skip
+        n = min(n - skip, len(self))
+        if n == 0:
+            return 0
+        old_base = self._base
+        self._first += n
+        self._base = self._ends[self._first-1]
+        if self._first > len(self._ends) // 2:
+            del self._ends[:self._first]
+            self._first = 0
+        return self._base - old_base
+
+    def truncate(self, n):
+        # Forget the last n lines, returns the amount of rows they took
+        m = min(n, len(self))
+        self.skipped -= n - m
+        if m == 0:
+            return 0
+        old_total = self.total()
+        del self._ends[len(self._ends)-m:]
+        return old_total - self.total()
+
+    def total(self):
+        # rows of the lines measured
+        if len(self) == 0:
+            return 0
+        return self._ends[-1] - self._base
+
+    def start(self, idx):
+        # first row of measured line idx
+        if idx == 0:
+            return 0
+        return self._ends[self._first+idx-1] - self._base
+
+    def find(self, row):
+        # index of the measured line containing row
+        return bisect.bisect_right(self._ends, row + self._base, self._first) - self._first
+
+    def rows(self, lines, first, count):
+        # The wrapped rows first...first+count-1 of lines, as (line, row of
+        # the line) pairs
+        w = self.width
+        idx = self.find(first)
+        row = first - self.start(idx)
+        idx += self.skipped
+        while count > 0 and idx < len(lines):
+            line = lines[idx]
+            n = line.rows(w)
+            while count > 0 and row < n:
+                yield line, row
+                row += 1
+                count -= 1
+            idx += 1
+            row = 0
 
 
 class WidgetContext:
@@ -213,35 +438,115 @@ class WidgetContext:
         self.widgets = dict()
         self.focus = ''
         self.cursor = None
+        self.panel = None # id of the panel being rendered
+        self._clear_focus_ring()
 
     def clear(self):
         self.widgets = dict()
         self.focus = ''
         self.cursor = None
+        self._clear_focus_ring()
 
-    def render_text_input(self, name, screen, x, y, w, h, focus_order):
-
-        if not name in self.widgets:
-            self.widgets[name] = {'value': '', 'cursor': 0}
+    def _clear_focus_ring(self):
+        # Widgets with a focus order form a ring that Up/Down move along.
+        # It's kept sorted as widgets register, so moving is a lookup.
+        self._ring = [] # sorted (focus order, name)
+        self._next = dict() # name -> name of the next widget in the ring
+        self._prev = dict()
 
+    def _register_focus(self, name, focus_order):
         widget = self.widgets[name]
+        if widget.get('focus_order') == focus_order:
+            return
+        if 'focus_order' in widget:
+            self._unlink_focus(name)
         widget['focus_order'] = focus_order
 
-        screen.addstr(y, x, ' ' * (w-1), 0)
-        screen.addstr(y, x, widget['value'][:w-1], 0)
+        key = (focus_order, name)
+        idx = bisect.bisect(self._ring, key)
+        self._ring.insert(idx, key)
+        before = self._ring[idx-1][1]
+        after = self._ring[(idx+1) % len(self._ring)][1]
+        self._next[before] = name
+        self._prev[name] = before
+        self._next[name] = after
+        self._prev[after] = name
+
+    def _unlink_focus(self, name):
+        key = (self.widgets[name]['focus_order'], name)
+        del self._ring[bisect.bisect_left(self._ring, key)]
+        before = self._prev.pop(name)
+        after = self._next.pop(name)
+        if before != name:
+            self._next[before] = after
+            self._prev[after] = before
+
+    def _text_widget(self, name, value=''):
+        if not name in self.widgets:
+            self.widgets[name] = {'buffer': GapBuffer.GapBuffer(value), 'offset': 0}
+        return self.widgets[name]
+
+    def render_text_input(self, name, screen, x, y, w, h, focus_order):
+
+        widget = self._text_widget(name)
+        self._register_focus(name, focus_order)
+        widget['panel'] = self.panel
+
+        buf = widget['buffer']
+        value = buf.text()
+        cur = buf.cursor
+        avail = w-1
+        if avail <= 0:
+            return
+
+        # Scroll horizontally so that the cursor stays in view
+        offset = min(widget['offset'], cur)
+        if TextWidth.width(value[offset:cur]) >= avail:
+            offset = cur
+            cells = 0
+            while offset > 0:
+                cw = TextWidth.char_width(value[offset-1])
+                if cells + cw >= avail:
+                    break
+                cells += cw
+                offset -= 1
+        widget['offset'] = offset
+
+        screen.addstr(y, x, TextWidth.pad(value[offset:], avail), 0)
 
         if name == self.focus:
-            self.cursor = (x + widget['cursor'], y)
+            # cursor is in screen coordinates
+            by, bx = screen.getbegyx()
+            self.cursor = (bx + x + TextWidth.width(value[offset:cur]), by + y)
 
     def get_text(self, name):
         if not name in self.widgets:
             return ''
 
-        return self.widgets[name]['value']
+        return self.widgets[name]['buffer'].text()
 
-    def set_text_default_value(self, name, value):
+    def get_text_cursor(self, name):
         if not name in self.widgets:
-            self.widgets[name] = {'value': value, 'cursor': 0}
+            return 0
+
+        return self.widgets[name]['buffer'].cursor
+
+    def set_text_default_value(self, name, value):
+        self._text_widget(name, value)
+
+    def set_text(self, name, value, cursor=None):
+        # The cursor goes to the end unless given
+        widget = self._text_widget(name)
+        widget['buffer'].set_text(value)
+        if cursor is not None:
+            widget['buffer'].move(cursor)
+        widget['offset'] = 0
+
+    def focus_panel(self):
+        # id of the panel showing the focused widget
+        if self.focus not in self.widgets:
+            return None
+        return self.widgets[self.focus].get('panel')
 
     def set_focus(self, name=None):
         if name is not None:
@@ -250,53 +555,46 @@ class WidgetContext:
             # find widget to focus on
             if len(self.widgets) == 0:
                 return
-            self.focus = list(self.widgets.keys())[0]
+            self.focus = next(iter(self.widgets))
 
     def on_navigate(self, event):
 
         if event == curses.KEY_UP or event == curses.KEY_DOWN:
 
-            if self.focus not in self.widgets:
-                return
-
             # Scroll thru widgets that have focus order defined
-            orders = sorted([v['focus_order'] for k, v in self.widgets.items() if 'focus_order' in v])
-            idx = orders.index(self.widgets[self.focus]['focus_order'])
-
-            idx += 1 if event == curses.KEY_DOWN else -1
-            idx %= len(orders)
-
-            self.focus = [k for k, v in self.widgets.items() if v['focus_order'] == orders[idx]][0]
+            if self.focus not in self._next:
+                return
+            if event == curses.KEY_DOWN:
+                self.focus = self._next[self.focus]
+            else:
+                self.focus = self._prev[self.focus]
             return
 
         if self.focus not in self.widgets:
             return
         w = self.widgets[self.focus]
 
+        buf = w['buffer']
+
         if event == curses.KEY_LEFT:
-            w['cursor'] = max(0, w['cursor']-1)
+            buf.move(buf.cursor-1)
         elif event == curses.KEY_RIGHT:
-            w['cursor'] = min(len(w['value']), w['cursor']+1)
+            buf.move(buf.cursor+1)
         elif event == curses.KEY_HOME:
-            w['cursor'] = 0
+            buf.move(0)
         elif event == curses.KEY_END:
-            w['cursor'] = len(w['value'])
+            buf.move(len(buf))
         elif event == curses.KEY_BACKSPACE or event == 8 or event == 127:
-
-            cur = w['cursor']
-            w['value'] = w['value'][:max(0, cur-1)]+w['value'][cur:]
-            w['cursor'] = max(0, w['cursor']-1)
+            buf.delete_back()
+        elif event == curses.KEY_DC:
+            buf.delete_forward()
 
     def on_character(self, text):
 
         self.set_focus()
         if self.focus not in self.widgets:
             return
-        w = self.widgets[self.focus]
-
-        cur = w['cursor']
-        w['value'] = w['value'][:cur] + text + w['value'][cur:]
-        w['cursor'] += len(text)
+        self.widgets[self.focus]['buffer'].insert(text)
 
     def on_meta(self, event):
         pass
@@ -305,126 +603,439 @@ class WidgetContext:
         return self.cursor
 
 
-class Canvas:
+# Color pairs used by the render functions: pair -> (foreground, background).
+# find_color_pair() adds more as they're needed.
+COLOR_PAIRS = {
+    1: (curses.COLOR_GREEN, -1),
+    2: (curses.COLOR_WHITE, curses.COLOR_BLACK),
+    3: (curses.COLOR_WHITE, curses.COLOR_RED),
+}
 
-    def __init__(self, event, mutex, callbacks):
-        self._root = Panel()
-        self._event = event
-        self._mutex = mutex
-        self._halt = False
+# Pairs beyond this are never allocated, it's the most curses can put in
+# the attributes of a character
+MAX_COLOR_PAIRS = 256
 
-        self._inbuffer = bytearray() # user-written text, raw. When conversion to utf8 succeeds, push upstream
+_color_pair_numbers = dict() # (foreground, background) -> allocated pair
 
-        self._cursorXY = (0,0)
-        self._screen = None
-        self._widget_context = WidgetContext()
-        self._callbacks = callbacks
+class CursesBackend:
+    # Draws on the terminal through curses. Other backends, such as
+    # Headless.Backend, provide the same methods and windows with the part
+    # of the curses window API the UI uses.
 
-    def refresh(self):
+    # Bytes written to the terminal by the last doupdate(), None if the
+    # backend can't tell
+    frame_bytes = None
 
-        with self._mutex:
-            if self._screen is None:
-                return
+    _colors = False # whether colors can be set up, known once started
 
-            size = self._screen.getmaxyx()
-            self._root.setDimensions(0, 0, size[1], size[0])
-            self._widget_context.set_focus()
-            self._root.render(self._screen, self._widget_context)
-            cursor = self._widget_context.get_cursor()
-            if cursor is None:
-                cursor = (0,0)
-            self._screen.move(cursor[1], cursor[0])
-            self._screen.refresh()
-
-    def _run(self, screen):
+    def start(self, screen):
         curses.noecho() 
         curses.curs_set(2)
         curses.nonl() # leave newline mode
         curses.cbreak()
-        curses.halfdelay(10)
         screen.leaveok(0)
         screen.scrollok(0)
         screen.keypad(1)
 
-        screen.timeout(100) # 100ms
+        # Keys are read when the event loop sees input on the terminal,
+        # getch() never blocks
+        screen.nodelay(1)
 
-        if curses.has_colors():
+        self._colors = curses.has_colors()
+        if self._colors:
             curses.use_default_colors()
-            curses.init_pair(1, curses.COLOR_GREEN, -1)
-            curses.init_pair(2, curses.COLOR_WHITE, curses.COLOR_BLACK)
-            curses.init_pair(3, curses.COLOR_WHITE, curses.COLOR_RED)
+            for n, (fg, bg) in COLOR_PAIRS.items():
+                self.init_pair(n, fg, bg)
 
-        escape = False # Whether an escape character was read from getch() previously
+        # Have the terminal mark pasted text, so that a paste is inserted
+        # at once instead of key by key
+        self._write_terminal(b'\x1b[?2004h')
 
-        with self._mutex:
-            self._screen = screen
-            self.refresh()
+    def stop(self):
+        self._write_terminal(b'\x1b[?2004l')
+
+    def _write_terminal(self, data):
+        sys.__stdout__.flush()
+        os.write(sys.__stdout__.fileno(), data)
+
+    def on_resize(self):
+        size = os.get_terminal_size(sys.__stdout__.fileno())
+        curses.resizeterm(size.lines, size.columns)
+
+    def run(self, fn):
+        return curses.wrapper(fn)
+
+    def newpad(self, h, w):
+        return curses.newpad(h, w)
+
+    def doupdate(self):
+        curses.doupdate()
 
-        try:
-            while not self._halt:
-
-                if self._event.is_set():
-                    self._event.clear()
-                    self.refresh()
-
-                event = screen.getch()
-
-                with self._mutex:
-                    if event == 27: #Escape!
-                        escape = True
-                    elif escape:
-                        if 'meta' in self._callbacks:
-                            self._callbacks['meta'](event)
-                        escape = False
-                    elif event == curses.KEY_RESIZE:
-                        # on resize we clear the whole screen
-                        screen.clear()
-                    elif event in [
-                        curses.KEY_LEFT,
-                        curses.KEY_RIGHT,
-                        curses.KEY_UP,
-                        curses.KEY_DOWN,
-                        curses.KEY_HOME,
-                        curses.KEY_END,
-                        curses.KEY_ENTER,
-                        13, # newline
-                        curses.KEY_BACKSPACE,
-                        8,  # backspace?
-                        127,# more backspaces?
-                        curses.KEY_DC # delete-key
-                    ]:
-                        self._widget_context.on_navigate(event)
-                        if 'navigate' in self._callbacks:
-                            self._callbacks['navigate'](event)
-                    elif event == 10: # linefeed
-                        pass
-                    elif event > 0 and event < 256:
-                        self._inbuffer.append(event)
-                        try:
-                            buf = str(self._inbuffer, 'utf-8')
-                            self._widget_context.on_character(buf)
-                            if 'character' in self._callbacks:
-                                self._callbacks['character'](buf)
-                            self._inbuffer = bytearray()
-                        except UnicodeDecodeError: pass
-                    if event != -1:
-                        self.refresh()
-        except KeyboardInterrupt:
+    def color_pair(self, n):
+        return curses.color_pair(n)
+
+    def init_pair(self, n, fg, bg):
+        # Pairs allocated before start() are set up by it
+        if not self._colors or n >= curses.COLOR_PAIRS:
             return
+        # Bright colors fall back to the normal ones on 8 color terminals
+        if fg >= curses.COLORS:
+            fg %= 8
+        if bg >= curses.COLORS:
+            bg %= 8
+        curses.init_pair(n, fg, bg)
+
+# The backend of the canvas. Render functions create pads and look up colors
+# through it instead of calling curses directly.
+backend = CursesBackend()
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+def newpad(h, w):
+    return backend.newpad(h, w)
+
+def color_pair(n):
+    return backend.color_pair(n)
+
+def find_color_pair(fg, bg):
+    # Number of the pair of fg on bg, allocating it the first time. Falls
+    # back to the default colors (pair 0) when out of pairs.
+    n = _color_pair_numbers.get((fg, bg))
+    if n is None:
+        n = len(COLOR_PAIRS) + 1
+        if n >= MAX_COLOR_PAIRS:
+            return 0
+        COLOR_PAIRS[n] = (fg, bg)
+        _color_pair_numbers[(fg, bg)] = n
+        backend.init_pair(n, fg, bg)
+    return n
+
+
+class RenderScheduler:
+    # Limits redraws to fps frames per second. Redraw requests only mark a
+    # frame as pending, the UI loop draws it once the frame interval since
+    # the previous frame has passed.
+
+    def __init__(self, fps):
+        self.interval = 1.0 / fps
+        self.pending = False
+        self.last_frame = 0.0
+
+    def request(self):
+        self.pending = True
+
+    def timeout(self):
+        # Seconds until the pending frame is due, None if nothing is pending
+        if not self.pending:
+            return None
+        return max(0.0, self.last_frame + self.interval - time.monotonic())
+
+    def due(self):
+        return self.pending and self.timeout() == 0
+
+    def frame_done(self):
+        self.pending = False
+        self.last_frame = time.monotonic()
 
-    def layout(self, string):
+
+class Canvas:
+
+    # Keys handled by WidgetContext.on_navigate
+    NAVIGATION_KEYS = (
+        curses.KEY_LEFT,
+        curses.KEY_RIGHT,
+        curses.KEY_UP,
+        curses.KEY_DOWN,
+        curses.KEY_HOME,
+        curses.KEY_END,
+        curses.KEY_PPAGE,
+        curses.KEY_NPAGE,
+        curses.KEY_ENTER,
+        13, # newline
+        curses.KEY_BACKSPACE,
+        8,  # backspace?
+        127,# more backspaces?
+        curses.KEY_DC, # delete-key
+        9, # tab, completion is up to the UI
+    )
+
+    # Max amount of (layout, rows, cols) entries in the geometry cache
+    GEOMETRY_CACHE_SIZE = 64
+
+    # A resize is applied once the terminal size has been left alone for
+    # this many seconds
+    RESIZE_DELAY = 0.1
+
+    def __init__(self, bus, fps=30, wakeup=None, stats=None, backend=None):
+        self._root = Panel()
+        self._layouts = dict() # name -> compiled Panel tree
+        self._layout_name = None
+        self._renderFns = dict() # panel id -> render function, for all layouts
+        self._geometry = dict() # (layout, rows, cols) -> leaf rectangles
+        self._size = None # (layout, rows, cols) the current tree is laid out for
+        self._bus = bus
+        self._scheduler = RenderScheduler(fps)
+        self._wakeup = wakeup # wakes up the event loop when a frame is requested
+        self._resize_at = None # when the pending resize is applied, None if there's none
+        self._stats = stats if stats is not None else Stats.Stats()
+        self._backend = backend if backend is not None else CursesBackend()
+        set_backend(self._backend)
+
+        # User-written text is decoded as it's read, a character split over
+        # several reads is kept in the decoder until it's complete
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._typed = [] # text typed during the current burst of input
+        self._escape = None # bytes of the escape sequence being read, None outside of one
+        self._paste = None # bytes of the bracketed paste being read, None outside of one
+
+        self._cursorXY = (0,0)
+        self._screen = None
         self._widget_context = WidgetContext()
-        self._root.layout(string)
 
-    def renderFn(self, panel_id, fn):
-        # wrap the given function inside a mutex lock:
-        def func(screen, widget_context, panel_id, x, y, w, h):
-            with self._mutex:
-                fn(screen, widget_context, panel_id, x, y, w, h)
-        self._root.renderFn(panel_id, func)
+    def schedule(self):
+        # Redraw on the next frame. Unlike refresh(), this is cheap and can
+        # be called as often as needed.
+        if self._scheduler.pending:
+            return
+        self._scheduler.request()
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def timeout(self):
+        # Seconds until update() has a frame to draw or a resize to apply,
+        # None if there's neither
+        timeout = self._scheduler.timeout()
+        if self._resize_at is not None:
+            wait = max(0.0, self._resize_at - time.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def update(self):
+        # Apply the pending resize or draw the pending frame, if it's due
+        if self._resize_at is not None and time.monotonic() >= self._resize_at:
+            self._resize()
+        elif self._scheduler.due():
+            self.refresh()
+
+    def refresh(self):
+        # Redraw now
+
+        if self._screen is None:
+            return
+
+        self._scheduler.frame_done()
+        self._stats.redraws.add()
+
+        # Deliver coalesced events once per frame
+        self._bus.flush()
+
+        self._updateGeometry()
+        self._widget_context.set_focus()
+        # Flush changes to the screen itself (e.g. a clear() after resize)
+        # first, so that they don't paint over the panels
+        self._screen.noutrefresh()
+        self._root.render(self._screen, self._widget_context)
+        for leaf in self._root.leaves():
+            if leaf.render_time is None:
+                self._stats.panel(leaf._id).skip()
+            else:
+                self._stats.panel(leaf._id).add(leaf.render_time)
+        cursor = self._widget_context.get_cursor()
+        if cursor is None:
+            cursor = (0,0)
+        self._screen.move(cursor[1], cursor[0])
+        self._screen.noutrefresh()
+        self._backend.doupdate()
+
+    def _updateGeometry(self):
+        # Lay out the current tree, unless it's already laid out for this
+        # terminal size. Geometry of every layout and size is computed once.
+
+        rows, cols = self._screen.getmaxyx()
+        key = (self._layout_name, rows, cols)
+        if key == self._size:
+            return
+        self._size = key
+
+        leaves = self._root.leaves()
+        if key in self._geometry:
+            for leaf, rect in zip(leaves, self._geometry[key]):
+                leaf.setDimensions(*rect)
+        else:
+            self._root.setDimensions(0, 0, cols, rows)
+            self._root.layoutTree()
+
+            if len(self._geometry) >= Canvas.GEOMETRY_CACHE_SIZE:
+                self._geometry = dict()
+            self._geometry[key] = [(leaf._x, leaf._y, leaf._w, leaf._h) for leaf in leaves]
+
+        # Before the screen is flushed, see Panel.releaseWindow()
+        for leaf in leaves:
+            leaf.releaseWindow()
 
-    def run(self):
-        curses.wrapper(self._run)
+    def invalidate(self, panel_id=None):
+        # Schedule panel_id (or everything) to be redrawn on the next refresh
+        self._root.invalidate(panel_id)
+
+    def _invalidate_focus(self):
+        panel_id = self._widget_context.focus_panel()
+        if panel_id is not None:
+            self._root.invalidate(panel_id)
+
+    def start(self, screen):
+        self._backend.start(screen)
+        self._screen = screen
+        self.refresh()
 
     def stop(self):
-        self._halt = True
+        self._backend.stop()
+        self._screen = None
+
+    def on_resize(self):
+        # Called on SIGWINCH. Dragging a terminal edge sends a stream of
+        # them, so the resize waits until they stop instead of clearing and
+        # redrawing everything for each one.
+        if self._screen is None:
+            return
+        self._resize_at = time.monotonic() + Canvas.RESIZE_DELAY
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def _resize(self):
+        # The signal doesn't reach curses, so tell it about the new size
+        self._resize_at = None
+        self._backend.on_resize()
+        self._screen.clear()
+        self._root.invalidate()
+        self.refresh()
+
+    def on_input(self):
+        # The terminal is readable. curses may buffer several keys from one
+        # read, so keep going until getch() runs dry. The text typed in
+        # between is inserted at once and the screen is redrawn once for the
+        # whole burst.
+
+        keys = 0
+        while self._screen is not None:
+            event = self._screen.getch()
+            if event == -1:
+                break
+            self._on_key(event)
+            keys += 1
+        self._flush_typed()
+
+        # Keystrokes are drawn right away, typing shouldn't wait for the
+        # next frame. A paste is drawn once it has been read completely.
+        if keys > 0 and self._paste is None:
+            self.refresh()
+
+    def _on_paste(self, text):
+        # The input is a single line
+        text = ' '.join(text.splitlines()).replace('\t', ' ')
+        self._widget_context.on_character(text)
+        self._invalidate_focus()
+        self._bus.publish(EventBus.KeyCharacter(text))
+
+    def _on_key(self, event):
+        screen = self._screen
+
+        typing = (self._paste is None and self._escape is None and event > 0 and event < 256
+                  and event != 27 and event != 10 and event not in Canvas.NAVIGATION_KEYS)
+        if not typing:
+            # Keep the order of typed text and other keys
+            self._flush_typed()
+
+        if self._paste is not None:
+            # Everything up to the end marker is pasted text
+            if event < 256:
+                self._paste.append(event)
+            if self._paste.endswith(b'\x1b[201~'):
+                text = str(self._paste[:-6], 'utf-8', 'replace')
+                self._paste = None
+                self._on_paste(text)
+        elif self._escape is not None:
+            if len(self._escape) == 0 and event != ord('['):
+                self._escape = None
+                self._bus.publish(EventBus.KeyMeta(event))
+            elif event < 256:
+                # Control sequence, read up to the final byte. Keys curses
+                # knows about never get here, they are translated already.
+                self._escape.append(event)
+                if len(self._escape) > 1 and event >= 0x40 and event <= 0x7e:
+                    if self._escape == b'[200~':
+                        self._paste = bytearray()
+                    self._escape = None
+            else:
+                self._escape = None
+        elif event == 27: #Escape!
+            self._escape = bytearray()
+        elif event == curses.KEY_RESIZE:
+            # curses noticed the resize itself, or queued this after ours
+            if self._size is None or screen.getmaxyx() != self._size[1:]:
+                self.on_resize()
+        elif event in Canvas.NAVIGATION_KEYS:
+            # Focus may move, so redraw the panels of both widgets
+            self._invalidate_focus()
+            self._widget_context.on_navigate(event)
+            self._invalidate_focus()
+            self._bus.publish(EventBus.KeyNavigate(event))
+            if event == 13 or event == curses.KEY_ENTER:
+                focus = self._widget_context.focus
+                if focus in self._widget_context.widgets:
+                    self._bus.publish(EventBus.Submit(focus, self._widget_context.get_text(focus)))
+        elif event == 10: # linefeed
+            pass
+        elif event > 0 and event < 256:
+            text = self._decoder.decode(bytes((event,)))
+            if len(text) > 0:
+                self._typed.append(text)
+
+    def _flush_typed(self):
+        # Insert the text typed so far at once
+        if len(self._typed) == 0:
+            return
+        text = ''.join(self._typed)
+        self._typed = []
+        self._widget_context.on_character(text)
+        self._invalidate_focus()
+        self._bus.publish(EventBus.KeyCharacter(text))
+
+    def get_text(self, name):
+        return self._widget_context.get_text(name)
+
+    def get_text_cursor(self, name):
+        return self._widget_context.get_text_cursor(name)
+
+    def set_text(self, name, value, cursor=None):
+        self._widget_context.set_text(name, value, cursor)
+        panel_id = self._widget_context.widgets[name].get('panel')
+        if panel_id is not None:
+            self._root.invalidate(panel_id)
+        self.schedule()
+
+    def add_layout(self, name, string):
+        # Parse the layout string once, set_layout() only switches trees
+        root = Panel()
+        root.layout(string)
+        for panel_id, func in self._renderFns.items():
+            root.renderFn(panel_id, func)
+        self._layouts[name] = root
+
+    def set_layout(self, name):
+        self._widget_context = WidgetContext()
+        self._layout_name = name
+        self._root = self._layouts[name]
+        self._root.invalidate()
+
+    def layout(self, string):
+        # Use a layout string directly, it's still compiled only once
+        if string not in self._layouts:
+            self.add_layout(string, string)
+        self.set_layout(string)
+
+    def renderFn(self, panel_id, func):
+        self._renderFns[panel_id] = func
+        for root in self._layouts.values():
+            root.renderFn(panel_id, func)
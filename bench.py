@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Renders the UI on a headless screen and prints the time per frame
+
+import sys
+import time
+
+import os
+
+import Ansi
+import Headless
+import UI
+
+def measure(name, frames, fn):
+    written = backend.total_bytes if ansi else 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    elapsed = time.perf_counter() - start
+    line = '%-20s %8.3f ms/frame' % (name, elapsed * 1000 / frames)
+    if ansi:
+        line += ' %8d bytes/frame' % ((backend.total_bytes - written) // frames)
+    print(line)
+
+if __name__ == '__main__':
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) > 0 and len(args) != 3:
+        print('Usage: %s [cols rows frames] [--snapshot] [--backend=ansi]' % sys.argv[0])
+        sys.exit(1)
+    cols, rows, frames = map(int, args) if len(args) == 3 else (300, 100, 200)
+
+    # The ANSI backend writes its frames to /dev/null
+    ansi = '--backend=ansi' in sys.argv
+    if ansi:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        backend = Ansi.Backend(devnull, devnull)
+        backend.resize(rows, cols)
+    else:
+        backend = Headless.Backend(rows, cols)
+    ui = UI.IRCUI(backend=backend)
+    for i in range(5000):
+        ui.pushStatusMessage('message %d: ' % i + 'lorem ipsum dolor sit amet ' * (i % 7))
+    ui.layout.start(backend.screen)
+
+    print('%dx%d, %d frames' % (cols, rows, frames))
+
+    def full():
+        ui.layout.invalidate()
+        ui.layout.refresh()
+    measure('full redraw', frames, full)
+
+    counter = [0]
+    def message():
+        counter[0] += 1
+        ui.pushStatusMessage('new message %d' % counter[0])
+        ui.layout.refresh()
+    measure('new message', frames, message)
+
+    measure('nothing changed', frames, ui.layout.refresh)
+
+    print()
+    for name, timing in sorted(ui.stats.panels.items()):
+        print('%-20s %8.3f ms p99' % (name, timing.percentile(0.99) * 1000))
+
+    if '--snapshot' in sys.argv:
+        print('\n'.join(backend.snapshot()))
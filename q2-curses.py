@@ -2,36 +2,41 @@
 # -*- coding: utf-8 -*-
 
 import locale
-import asyncore
 import UI
+import UIEngine
+import Ansi
 import sys
 
+# Screen backends selectable with --backend=name
+BACKENDS = {
+    'curses': UIEngine.CursesBackend,
+    'ansi': Ansi.Backend, # diffs frames itself, sends less over slow links
+}
+
 class Application:
 
-    def __init__(self):
-        self.ui = UI.IRCUI()
+    def __init__(self, backend=None):
+        self.ui = UI.IRCUI(backend)
 
     def run(self, hostport):
 
+        # The UI event loop also drives the core connection
         self.ui.connect(hostport)
         self.ui.run()
 
-        try:
-            while self.ui.isRunning():
-                asyncore.loop(timeout=1, count=1)
-        except KeyboardInterrupt:
-            pass
-        except Exception as e:
-            self.ui.pushMessage('Exception in main loop: ' + str(e))
-        self.ui.stop()
-
 if __name__ == '__main__':
     locale.setlocale(locale.LC_ALL,"")
 
-    if len(sys.argv) < 3:
-        print('Usage: %s core-host core-port' % sys.argv[0])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    backend = 'curses'
+    for arg in sys.argv[1:]:
+        if arg.startswith('--backend='):
+            backend = arg[len('--backend='):]
+
+    if len(args) < 2 or backend not in BACKENDS:
+        print('Usage: %s [--backend=curses|ansi] core-host core-port' % sys.argv[0])
         sys.exit(1)
 
-    app = Application()
-    app.run((sys.argv[1], int(sys.argv[2])))
+    app = Application(BACKENDS[backend]())
+    app.run((args[0], int(args[1])))
 
@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import Headless
+import UIComponents
+import UIEngine
+
+class ScrolledUpTest(unittest.TestCase):
+    # A window scrolled up past the lines in memory, with more lines paged
+    # in than max_paged, keeps showing the same lines as new ones arrive
+
+    H = 20
+    W = 60
+
+    def setUp(self):
+        self.backend = Headless.Backend(self.H, self.W)
+        UIEngine.set_backend(self.backend)
+        self.window = UIComponents.TextWindow('test')
+
+    def tearDown(self):
+        self.window.lines.close()
+
+    def screen(self):
+        self.window.render(self.backend.screen, None, 0, 0, self.W, self.H)
+        self.backend.doupdate()
+        return [row.rstrip() for row in self.backend.snapshot()]
+
+    def test_viewport_stays_still(self):
+        window = self.window
+        for i in range(5000):
+            window.push_message('line %d' % i)
+        self.screen()
+        for _ in range(300):
+            window.scroll_page(1)
+            self.screen()
+        for _ in range(250):
+            window.scroll_page(-1)
+            self.screen()
+
+        before = self.screen()
+        for i in range(3000):
+            window.push_message('new %d' % i)
+            self.assertEqual(self.screen(), before, 'after %d new lines' % (i + 1))
+            self.assertLessEqual(len(window.lines._paged), window.lines.max_paged)
+
+    def test_viewport_stays_still_while_hidden(self):
+        # Lines arriving with no redraws in between
+        window = self.window
+        for i in range(5000):
+            window.push_message('line %d' % i)
+        self.screen()
+        for _ in range(200):
+            window.scroll_page(1)
+            self.screen()
+
+        before = self.screen()
+        for i in range(10000):
+            window.push_message('new %d' % i)
+        self.assertLessEqual(len(window.lines._paged), window.lines.max_paged)
+        self.assertEqual(self.screen(), before)
+
+if __name__ == '__main__':
+    unittest.main()